@@ -1,118 +1,2472 @@
 # Importing libraries and modules
+import time
+# Inicio del proceso, para medir las fases del arranque
+STARTED_AT = time.monotonic()
 import os
 import discord
 from discord.ext import commands
 from discord import app_commands
 from dotenv import load_dotenv
-import yt_dlp # NEW
 from collections import deque # NEW
 import asyncio # NEW
+import itertools
+import random
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import weakref
+import shutil
+import signal
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from urllib.parse import urlparse, parse_qs
 
 # Environment variables for tokens and other sensitive data
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
 
-# Create the structure for queueing songs - Dictionary of queues
-SONG_QUEUES = {}
+class _QueueNode:
+    __slots__ = ("uid", "track", "duration", "priority", "size", "left", "right", "parent")
+
+    def __init__(self, uid, track):
+        self.uid = uid
+        self.track = track
+        # Duración al entrar en la cola, para mantener el total sin recorrerla
+        self.duration = getattr(track, "duration", None)
+        self.priority = random.random()
+        self.size = 1
+        self.left = None
+        self.right = None
+        self.parent = None
+
+
+def _node_size(node):
+    return node.size if node is not None else 0
+
+
+def _pull(node):
+    node.size = 1 + _node_size(node.left) + _node_size(node.right)
+    if node.left is not None:
+        node.left.parent = node
+    if node.right is not None:
+        node.right.parent = node
+
+
+def _merge(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.priority > b.priority:
+        a.right = _merge(a.right, b)
+        _pull(a)
+        return a
+    b.left = _merge(a, b.left)
+    _pull(b)
+    return b
+
+
+def _split(node, k):
+    """Separa los k primeros nodos (en orden) del resto."""
+    if node is None:
+        return None, None
+    if _node_size(node.left) >= k:
+        left, right = _split(node.left, k)
+        node.left = right
+        _pull(node)
+        return left, node
+    left, right = _split(node.right, k - _node_size(node.left) - 1)
+    node.right = left
+    _pull(node)
+    return node, right
+
+
+class TrackQueue:
+    """Cola de reproducción indexada.
+
+    Las primeras canciones viven en un deque pequeño (sacar por delante es O(1)
+    amortizado) y el resto en un treap implícito, así que acceder, borrar o mover
+    por posición cuesta O(log n). Cada entrada tiene un ID estable (uid) que no
+    cambia al mezclar ni al mover canciones, y "version" aumenta con cada cambio.
+    La duración total se actualiza al añadir y quitar canciones.
+    """
+
+    # Canciones que se pasan de golpe del treap al deque de cabeza
+    HEAD_CHUNK = 32
+
+    def __init__(self, tracks=()):
+        self._head = deque()
+        self._root = None
+        self._nodes = {}
+        self._next_uid = itertools.count(1)
+        self.version = 0
+        # Suma de las duraciones conocidas y cuántas canciones no tienen duración
+        self.total_duration = 0
+        self.unknown_durations = 0
+        self.extend(tracks)
+
+    def __len__(self):
+        return len(self._head) + _node_size(self._root)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        for node in self._iter_nodes(0):
+            yield node.track
+
+    def __getitem__(self, index):
+        return self._node_at(index).track
+
+    # -- Operaciones internas --
+
+    def _changed(self):
+        self.version += 1
+
+    def _new_node(self, track):
+        node = _QueueNode(next(self._next_uid), track)
+        self._nodes[node.uid] = node
+        if node.duration:
+            self.total_duration += node.duration
+        else:
+            self.unknown_durations += 1
+        return node
 
-# Diccionario para controlar el modo de bucle para cada servidor
-# Valores posibles: "none", "song", "queue"
-LOOP_MODES = {}
+    def _drop_node(self, node):
+        del self._nodes[node.uid]
+        if node.duration:
+            self.total_duration -= node.duration
+        else:
+            self.unknown_durations -= 1
+
+    def _set_root(self, root):
+        self._root = root
+        if root is not None:
+            root.parent = None
+
+    def _refill_head(self):
+        # Pasar un bloque de canciones del treap al deque de cabeza
+        chunk, rest = _split(self._root, self.HEAD_CHUNK)
+        self._set_root(rest)
+        self._head.extend(self._inorder(chunk))
+
+    def _spill_head(self):
+        # Si el deque de cabeza crece demasiado, devolver lo que sobra al treap
+        if len(self._head) <= 2 * self.HEAD_CHUNK:
+            return
+        spilled = None
+        while len(self._head) > self.HEAD_CHUNK:
+            node = self._head.pop()
+            node.left = node.right = None
+            node.size = 1
+            spilled = _merge(node, spilled)
+        self._set_root(_merge(spilled, self._root))
+
+    @staticmethod
+    def _inorder(node):
+        stack = []
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node
+            node = node.right
+
+    def _iter_nodes(self, start):
+        """Recorre los nodos desde la posición start sin copiar la cola."""
+        head_len = len(self._head)
+        for i in range(start, head_len):
+            yield self._head[i]
+        k = max(0, start - head_len)
+        # Bajar hasta el k-ésimo nodo guardando el camino para seguir en orden
+        stack = []
+        node = self._root
+        while node is not None:
+            left_size = _node_size(node.left)
+            if k < left_size:
+                stack.append(node)
+                node = node.left
+            elif k == left_size:
+                stack.append(node)
+                break
+            else:
+                k -= left_size + 1
+                node = node.right
+        while stack:
+            node = stack.pop()
+            yield node
+            node = node.right
+            while node is not None:
+                stack.append(node)
+                node = node.left
+
+    def _check_index(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("posición fuera de la cola")
+        return index
+
+    def _node_at(self, index):
+        index = self._check_index(index)
+        if index < len(self._head):
+            return self._head[index]
+        k = index - len(self._head)
+        node = self._root
+        while True:
+            left_size = _node_size(node.left)
+            if k < left_size:
+                node = node.left
+            elif k == left_size:
+                return node
+            else:
+                k -= left_size + 1
+                node = node.right
+
+    def _detach_at(self, index):
+        index = self._check_index(index)
+        if index < len(self._head):
+            node = self._head[index]
+            del self._head[index]
+            return node
+        left, rest = _split(self._root, index - len(self._head))
+        node, right = _split(rest, 1)
+        self._set_root(_merge(left, right))
+        node.parent = None
+        return node
+
+    def _attach_at(self, index, node):
+        node.left = node.right = node.parent = None
+        node.size = 1
+        index = max(0, min(index, len(self)))
+        if index <= len(self._head):
+            self._head.insert(index, node)
+            self._spill_head()
+        else:
+            left, right = _split(self._root, index - len(self._head))
+            self._set_root(_merge(_merge(left, node), right))
 
-# Diccionario para controlar si las recomendaciones están activadas para cada servidor
-RECOMMENDATIONS_ENABLED = {}
+    # -- API pública --
 
-async def search_ytdlp_async(query, ydl_opts):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: _extract(query, ydl_opts))
+    def append(self, track):
+        node = self._new_node(track)
+        if self._root is None and len(self._head) < self.HEAD_CHUNK:
+            self._head.append(node)
+        else:
+            self._set_root(_merge(self._root, node))
+        self._changed()
+        return node.uid
+
+    def appendleft(self, track):
+        node = self._new_node(track)
+        self._head.appendleft(node)
+        self._spill_head()
+        self._changed()
+        return node.uid
+
+    def extend(self, tracks):
+        for track in tracks:
+            self.append(track)
+
+    def popleft(self):
+        if not self._head:
+            if self._root is None:
+                raise IndexError("popleft de una cola vacía")
+            self._refill_head()
+        node = self._head.popleft()
+        self._drop_node(node)
+        self._changed()
+        return node.track
+
+    def insert(self, index, track):
+        node = self._new_node(track)
+        self._attach_at(index, node)
+        self._changed()
+        return node.uid
+
+    def remove_at(self, index):
+        """Quita y devuelve la canción de la posición indicada (empezando en 0)."""
+        node = self._detach_at(index)
+        self._drop_node(node)
+        self._changed()
+        return node.track
+
+    def move(self, source, destination):
+        """Mueve una canción de posición conservando su uid."""
+        node = self._detach_at(source)
+        self._attach_at(destination, node)
+        self._changed()
+        return node.track
+
+    def index_of(self, uid):
+        """Posición actual de la entrada con ese uid."""
+        node = self._nodes.get(uid)
+        if node is None:
+            raise KeyError(uid)
+        try:
+            return self._head.index(node)
+        except ValueError:
+            pass
+        rank = _node_size(node.left)
+        while node.parent is not None:
+            if node is node.parent.right:
+                rank += _node_size(node.parent.left) + 1
+            node = node.parent
+        return len(self._head) + rank
+
+    def entries(self, start, stop):
+        """Devuelve [(uid, track)] entre start y stop, para mostrar una página."""
+        result = []
+        if start >= stop:
+            return result
+        for node in self._iter_nodes(start):
+            result.append((node.uid, node.track))
+            if len(result) >= stop - start:
+                break
+        return result
+
+    def shuffle(self, keep_first=False):
+        """Mezcla la cola intercambiando el contenido de los nodos, sin reconstruirla."""
+        nodes = list(self._iter_nodes(1 if keep_first else 0))
+        for i in range(len(nodes) - 1, 0, -1):
+            j = random.randint(0, i)
+            a, b = nodes[i], nodes[j]
+            a.track, b.track = b.track, a.track
+            a.uid, b.uid = b.uid, a.uid
+            a.duration, b.duration = b.duration, a.duration
+        for node in nodes:
+            self._nodes[node.uid] = node
+        self._changed()
+
+    def clear(self):
+        self._head.clear()
+        self._root = None
+        self._nodes.clear()
+        self.total_duration = 0
+        self.unknown_durations = 0
+        self._changed()
+
+
+# Tiempo sin actividad tras el cual se libera el estado de un servidor sin conexión de voz
+PLAYER_IDLE_TIMEOUT = int(os.getenv("PLAYER_IDLE_TIMEOUT", "900"))
+# Estado inicial de las recomendaciones automáticas en cada servidor
+RECOMMENDATIONS_ENABLED = os.getenv("RECOMMENDATIONS_ENABLED", "0") == "1"
+# Canciones recientes de cada servidor que no se vuelven a recomendar
+RECOMMENDATION_HISTORY = int(os.getenv("RECOMMENDATION_HISTORY", "50"))
+
+
+class GuildPlayer:
+    """Estado de reproducción de un servidor.
+
+    Se crea la primera vez que se usa y se libera cuando el bot se desconecta
+    del canal de voz o tras PLAYER_IDLE_TIMEOUT segundos sin actividad.
+    """
+
+    __slots__ = (
+        "guild_id", "queue", "loop_mode", "recommendations", "last_played", "last_active",
+        "prewarmed", "prefetch_task", "prewarm_task", "disconnect_task", "empty_channel_task", "empty_channel_id", "queue_pages",
+        "now_playing_message", "track_ended_at", "history", "last_track", "recommended", "recommend_task",
+        "now_playing", "now_playing_source", "failures", "skip_requested",
+    )
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        # Cola de canciones (objetos Track)
+        self.queue = TrackQueue()
+        # Modo de bucle. Valores posibles: "none", "song", "queue"
+        self.loop_mode = "none"
+        # Si las recomendaciones automáticas están activadas
+        self.recommendations = RECOMMENDATIONS_ENABLED
+        # Última canción reproducida, para las recomendaciones
+        self.last_played = None
+        self.last_active = time.monotonic()
+        # Fuente de audio abierta por adelantado para la siguiente canción: (track, source)
+        self.prewarmed = None
+        self.prefetch_task = None
+        self.prewarm_task = None
+        self.disconnect_task = None
+        # Temporizador de desconexión cuando el canal de voz se queda sin usuarios
+        self.empty_channel_task = None
+        # Canal de voz que vigila ese temporizador
+        self.empty_channel_id = None
+        # Páginas de /queue ya generadas: (versión de la cola, {página: embed})
+        self.queue_pages = None
+        # Mensaje "Now playing" que se edita en cada cambio de canción
+        self.now_playing_message = None
+        # Cuándo terminó la última canción, para medir el silencio hasta la siguiente
+        self.track_ended_at = None
+        # IDs de las últimas canciones reproducidas y la última canción (Track)
+        self.history = deque(maxlen=RECOMMENDATION_HISTORY)
+        self.last_track = None
+        # Recomendaciones preparadas en segundo plano: (ID de la canción semilla, [Track])
+        self.recommended = None
+        self.recommend_task = None
+        # Canción que está sonando (o que sonaba si el bot se desconectó a mitad)
+        self.now_playing = None
+        # Fuente (InstrumentedSource) de la canción actual, para saber por dónde va
+        self.now_playing_source = None
+        # Fallos de reproducción seguidos, para espaciar los reintentos
+        self.failures = 0
+        # La canción actual se ha cortado a propósito (skip/stop), no por un fallo
+        self.skip_requested = False
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def position(self):
+        """Segundo de la canción actual por el que va la reproducción."""
+        source = self.now_playing_source
+        return source.elapsed if source is not None and self.now_playing is not None else 0.0
+
+    def discard_prewarmed(self):
+        """Cierra la fuente abierta por adelantado, si la había."""
+        if self.prewarmed is not None:
+            self.prewarmed[1].cleanup()
+            self.prewarmed = None
+
+    def close(self):
+        """Cancela las tareas pendientes y libera los procesos del servidor."""
+        for task in (
+            self.prefetch_task, self.prewarm_task, self.disconnect_task, self.empty_channel_task, self.recommend_task,
+        ):
+            if task is not None and not task.done():
+                task.cancel()
+        self.discard_prewarmed()
+        self.queue.clear()
+
+
+# Reproductores activos, por ID de servidor (int)
+PLAYERS = {}
+
+# Funciones a las que se llama con el reproductor al crearlo y justo antes de liberarlo
+PLAYER_CREATED_HOOKS = []
+PLAYER_EVICTED_HOOKS = []
+
+
+def get_player(guild_id):
+    """Devuelve el reproductor del servidor, creándolo si no existe."""
+    player = PLAYERS.get(guild_id)
+    if player is None:
+        player = PLAYERS[guild_id] = GuildPlayer(guild_id)
+        for hook in PLAYER_CREATED_HOOKS:
+            hook(player)
+    player.touch()
+    return player
+
+
+def evict_player(guild_id):
+    """Libera el estado de un servidor."""
+    player = PLAYERS.pop(guild_id, None)
+    if player is not None:
+        # Los hooks ven el estado tal como estaba, antes de vaciar la cola
+        for hook in PLAYER_EVICTED_HOOKS:
+            hook(player)
+        player.close()
+
+
+async def evict_idle_players():
+    """Libera periódicamente los reproductores sin conexión de voz y sin actividad."""
+    while True:
+        await asyncio.sleep(60)
+        now = time.monotonic()
+        for guild_id, player in list(PLAYERS.items()):
+            guild = bot.get_guild(guild_id)
+            if guild is not None and guild.voice_client is not None:
+                continue
+            if now - player.last_active >= PLAYER_IDLE_TIMEOUT:
+                evict_player(guild_id)
+
+
+# Puerto local del endpoint de métricas en formato Prometheus (0 = desactivado)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# "json" para escribir los eventos como una línea JSON cada uno; "text" solo muestra avisos y errores
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+# Límites (en segundos) de los histogramas
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def log_event(event, level="info", **fields):
+    """Registra un evento estructurado."""
+    if LOG_FORMAT == "json":
+        print(json.dumps({"ts": round(time.time(), 3), "level": level, "event": event, **fields}, default=str), flush=True)
+    elif level != "info":
+        print(f"[{level}] {event} " + " ".join(f"{key}={value}" for key, value in fields.items()))
+
+
+class Metrics:
+    """Contadores e histogramas en memoria, exportados en formato de texto de Prometheus."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        # (nombre, etiquetas) -> [recuentos por límite..., suma, total]
+        self._histograms = {}
+        self._help = {}
+        # Se observan valores también desde el hilo de audio
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+    def _header(self, lines, seen, name, kind):
+        if name in seen:
+            return
+        seen.add(name)
+        kind, text = self._help.get(name, (kind, ""))
+        if text:
+            lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def render(self, gauges=()):
+        """Texto de exposición de Prometheus. gauges: (nombre, {etiquetas}, valor) calculados al momento."""
+        lines = []
+        seen = set()
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(values)) for key, values in self._histograms.items())
+        for (name, labels), value in counters:
+            self._header(lines, seen, name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), values in histograms:
+            self._header(lines, seen, name, "histogram")
+            for bound, count in zip(self.buckets, values):
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {values[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {values[-1]}")
+        for name, labels, value in gauges:
+            self._header(lines, seen, name, "gauge")
+            lines.append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+METRICS.describe("musicbot_loop_lag_seconds", "histogram", "Retraso del event loop respecto a lo programado")
+METRICS.describe("musicbot_extract_seconds", "histogram", "Latencia de extracción por punto de llamada y origen")
+METRICS.describe("musicbot_play_to_audio_seconds", "histogram", "Tiempo desde /play hasta el primer paquete de audio")
+METRICS.describe("musicbot_track_gap_seconds", "histogram", "Silencio entre el final de una canción y el inicio de la siguiente")
+METRICS.describe("musicbot_playback_errors_total", "counter", "Errores durante la reproducción")
+METRICS.describe("musicbot_stream_profile_total", "counter", "Streams abiertos por perfil de calidad")
+
+# Segundos desde el inicio del proceso hasta cada fase del arranque
+STARTUP_PHASES = {}
+
+
+def mark_startup(phase):
+    """Anota la primera vez que se alcanza una fase del arranque."""
+    if phase in STARTUP_PHASES:
+        return
+    seconds = round(time.monotonic() - STARTED_AT, 3)
+    STARTUP_PHASES[phase] = seconds
+    if LOG_FORMAT == "json":
+        log_event("startup_phase", phase=phase, seconds=seconds)
+    else:
+        print(f"Arranque: {phase} a los {seconds:.2f} s")
+
+
+# Cada cuánto se mide el retraso del event loop, y a partir de qué retraso se registra un aviso
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_WARNING = 0.1
+# Últimas medidas (unos 10 segundos), para la política de calidad
+RECENT_LOOP_LAG = deque(maxlen=20)
+
+
+async def monitor_loop_lag():
+    """Mide cuánto tarda el event loop en despertar una tarea respecto a lo programado."""
+    while True:
+        expected = time.monotonic() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.monotonic() - expected)
+        RECENT_LOOP_LAG.append(lag)
+        METRICS.observe("musicbot_loop_lag_seconds", lag)
+        if lag >= LOOP_LAG_WARNING:
+            log_event("loop_lag", level="warning", lag=round(lag, 3))
+
+# Configuración de la caché de extracción
+EXTRACT_CACHE_PATH = os.getenv("EXTRACT_CACHE_PATH", os.path.join("cache", "extract_cache.sqlite3"))
+EXTRACT_CACHE_SIZE = int(os.getenv("EXTRACT_CACHE_SIZE", "2000"))
+# Las URLs firmadas de googlevideo caducan a las ~6 horas; las damos por válidas bastante menos
+STREAM_URL_TTL = int(os.getenv("STREAM_URL_TTL", "3600"))
+# Margen de seguridad respecto al parámetro "expire" de la URL firmada
+STREAM_URL_MARGIN = 600
+# Las búsquedas de texto cambian poco, pero no conviene fijarlas para siempre
+QUERY_TTL = int(os.getenv("QUERY_TTL", "86400"))
+
+YOUTUBE_ID_RE = re.compile(r"(?:v=|youtu\.be/|shorts/|embed/|live/)([A-Za-z0-9_-]{11})")
+
+
+def normalize_query(query):
+    """Devuelve una clave estable para una búsqueda o URL de yt-dlp."""
+    query = query.strip()
+    if query.startswith(('https://', 'http://', 'www.')):
+        # Las listas de reproducción se identifican por la URL completa
+        if "list=" not in query:
+            match = YOUTUBE_ID_RE.search(query)
+            if match:
+                return "id:" + match.group(1)
+        return "url:" + query
+    prefix, sep, terms = query.partition(":")
+    if sep and prefix.startswith("ytsearch"):
+        return f"{prefix}:{' '.join(terms.lower().split())}"
+    return "q:" + " ".join(query.lower().split())
+
+
+def stream_url_expiry(url, now=None):
+    """Calcula hasta cuándo consideramos válida una URL de audio firmada."""
+    now = time.time() if now is None else now
+    expires_at = now + STREAM_URL_TTL
+    try:
+        parsed = urlparse(url)
+        expire = parse_qs(parsed.query).get("expire")
+        if expire:
+            expires_at = min(expires_at, int(expire[0]) - STREAM_URL_MARGIN)
+        else:
+            # Algunas URLs de googlevideo llevan los parámetros en la ruta (/expire/<ts>/)
+            parts = parsed.path.split("/")
+            if "expire" in parts:
+                expires_at = min(expires_at, int(parts[parts.index("expire") + 1]) - STREAM_URL_MARGIN)
+    except (ValueError, IndexError):
+        pass
+    return expires_at
+
+
+def trim_track(info):
+    """Se queda solo con los campos que usa el bot de la info de yt-dlp."""
+    return {
+        "id": info.get("id"),
+        "title": info.get("title", "Untitled"),
+        "duration": info.get("duration"),
+        "webpage_url": info.get("webpage_url") or info.get("url"),
+        "url": info.get("url"),
+        "acodec": info.get("acodec"),
+        "abr": info.get("abr"),
+    }
+
+
+class ExtractionCache:
+    """Caché de metadatos de yt-dlp con LRU en memoria y un nivel en disco (SQLite).
+
+    Las búsquedas se guardan como listas de IDs de vídeo y cada vídeo guarda
+    su título, duración, URL de la página y la URL de audio con su caducidad.
+    """
+
+    def __init__(self, path, max_items):
+        self.path = path
+        self.max_items = max_items
+        self._queries = OrderedDict()
+        self._tracks = OrderedDict()
+        # Un cerrojo para los diccionarios en memoria (también se usan desde el event loop)
+        # y otro para la conexión: el de memoria nunca se mantiene durante la E/S de disco
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        # La conexión se abre la primera vez que se usa, desde el hilo del executor
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Con varios procesos (launcher.py) todos comparten este archivo
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS queries (
+                    key TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    title TEXT,
+                    ids TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS tracks (
+                    id TEXT PRIMARY KEY,
+                    title TEXT,
+                    duration REAL,
+                    webpage_url TEXT,
+                    stream_url TEXT,
+                    stream_format TEXT,
+                    stream_expires REAL,
+                    updated_at REAL NOT NULL,
+                    acodec TEXT,
+                    abr REAL
+                );
+            """)
+            # Bases de datos creadas antes de guardar el códec del stream
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(tracks)")}
+            for column, kind in (("acodec", "TEXT"), ("abr", "REAL")):
+                if column not in columns:
+                    self._db.execute(f"ALTER TABLE tracks ADD COLUMN {column} {kind}")
+        return self._db
+
+    @staticmethod
+    def _key(query, ydl_opts):
+        return f"{ydl_opts.get('format', '')}|{normalize_query(query)}"
+
+    def _remember(self, store, key, value):
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > self.max_items:
+            store.popitem(last=False)
+
+    def _track_result(self, track, fmt, now, require_stream):
+        if track is None:
+            return None
+        # La URL de audio solo sirve si corresponde al mismo formato y no ha caducado
+        if track["stream_url"] and track["stream_format"] == fmt and track["stream_expires"] > now:
+            return {
+                "id": track["id"],
+                "title": track["title"],
+                "duration": track["duration"],
+                "webpage_url": track["webpage_url"],
+                "url": track["stream_url"],
+                "acodec": track["acodec"],
+                "abr": track["abr"],
+            }
+        if require_stream:
+            return None
+        # Igual que las entradas de una extracción "flat": solo metadatos
+        return {
+            "_type": "url",
+            "id": track["id"],
+            "title": track["title"],
+            "duration": track["duration"],
+            "webpage_url": track["webpage_url"],
+            "url": track["webpage_url"],
+        }
+
+    def _build_result(self, entry, ydl_opts, now):
+        fmt = ydl_opts.get("format", "")
+        # Las extracciones "flat" no necesitan URL de audio, se resuelve al reproducir
+        require_stream = not ydl_opts.get("extract_flat")
+        tracks = []
+        for video_id in entry["ids"]:
+            track = self._track_result(self._tracks.get(video_id), fmt, now, require_stream)
+            if track is None:
+                return None
+            tracks.append(track)
+        if entry["kind"] == "single":
+            return tracks[0] if tracks else None
+        return {"title": entry["title"], "entries": tracks}
+
+    @staticmethod
+    def _video_entry(key, now):
+        # Las URLs de un solo vídeo se resuelven directamente por su ID
+        normalized = key.partition("|")[2]
+        if normalized.startswith("id:"):
+            return {"kind": "single", "title": None, "ids": [normalized[3:]], "created_at": now}
+        return None
+
+    def get_memory(self, query, ydl_opts):
+        key = self._key(query, ydl_opts)
+        now = time.time()
+        with self._lock:
+            entry = self._queries.get(key)
+            if entry is None or entry["created_at"] + QUERY_TTL <= now:
+                entry = self._video_entry(key, now)
+                if entry is None:
+                    return None
+            for video_id in entry["ids"]:
+                if video_id in self._tracks:
+                    self._tracks.move_to_end(video_id)
+            result = self._build_result(entry, ydl_opts, now)
+            if result is not None:
+                if key in self._queries:
+                    self._queries.move_to_end(key)
+                self.memory_hits += 1
+            return result
+
+    def get_disk(self, query, ydl_opts):
+        key = self._key(query, ydl_opts)
+        now = time.time()
+        with self._db_lock:
+            db = self._connect()
+            row = db.execute(
+                "SELECT kind, title, ids, created_at FROM queries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[3] + QUERY_TTL > now:
+                entry = {"kind": row[0], "title": row[1], "ids": json.loads(row[2]), "created_at": row[3]}
+            else:
+                entry = self._video_entry(key, now)
+                if entry is None:
+                    self.misses += 1
+                    return None
+            with self._lock:
+                missing = [video_id for video_id in entry["ids"] if video_id not in self._tracks]
+            loaded = []
+            for video_id in missing:
+                track_row = db.execute(
+                    "SELECT id, title, duration, webpage_url, stream_url, stream_format, stream_expires, "
+                    "acodec, abr FROM tracks WHERE id = ?", (video_id,)
+                ).fetchone()
+                if track_row is None:
+                    self.misses += 1
+                    return None
+                loaded.append(dict(zip(
+                    ("id", "title", "duration", "webpage_url", "stream_url", "stream_format", "stream_expires",
+                     "acodec", "abr"),
+                    track_row,
+                )))
+        with self._lock:
+            for track in loaded:
+                # Otra extracción pudo guardar una versión más reciente mientras se leía el disco
+                if track["id"] not in self._tracks:
+                    self._remember(self._tracks, track["id"], track)
+            result = self._build_result(entry, ydl_opts, now)
+            if result is None:
+                self.misses += 1
+                return None
+            if row is not None:
+                self._remember(self._queries, key, entry)
+            self.disk_hits += 1
+            return result
+
+    def put(self, query, ydl_opts, results):
+        if not results:
+            return
+        key = self._key(query, ydl_opts)
+        fmt = ydl_opts.get("format", "")
+        now = time.time()
+        if "entries" in results:
+            kind = "entries"
+            infos = [info for info in results["entries"] if info and info.get("id")]
+        else:
+            kind = "single"
+            infos = [results] if results.get("id") else []
+        if not infos:
+            return
+        tracks = []
+        for info in infos:
+            trimmed = trim_track(info)
+            # Las entradas "flat" (_type == "url") solo traen la URL de la página
+            stream_url = trimmed["url"] if info.get("_type", "video") != "url" else None
+            tracks.append({
+                "id": trimmed["id"],
+                "title": trimmed["title"],
+                "duration": trimmed["duration"],
+                "webpage_url": trimmed["webpage_url"],
+                "stream_url": stream_url,
+                "stream_format": fmt if stream_url else None,
+                "stream_expires": stream_url_expiry(stream_url, now) if stream_url else 0,
+                "acodec": trimmed["acodec"] if stream_url else None,
+                "abr": trimmed["abr"] if stream_url else None,
+            })
+        entry = {
+            "kind": kind,
+            "title": results.get("title") if kind == "entries" else None,
+            "ids": [track["id"] for track in tracks],
+            "created_at": now,
+        }
+        with self._lock:
+            for track in tracks:
+                existing = self._tracks.get(track["id"])
+                if track["stream_url"] is None and existing is not None:
+                    # No perder una URL de audio válida por una extracción "flat" posterior
+                    for field in ("stream_url", "stream_format", "stream_expires", "acodec", "abr"):
+                        track[field] = existing[field]
+                self._remember(self._tracks, track["id"], track)
+            self._remember(self._queries, key, entry)
+        with self._db_lock:
+            db = self._connect()
+            with db:
+                db.executemany(
+                    """INSERT INTO tracks (id, title, duration, webpage_url, stream_url, stream_format,
+                                          stream_expires, updated_at, acodec, abr)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT(id) DO UPDATE SET
+                           title = excluded.title,
+                           duration = COALESCE(excluded.duration, tracks.duration),
+                           webpage_url = excluded.webpage_url,
+                           stream_url = COALESCE(excluded.stream_url, tracks.stream_url),
+                           stream_format = COALESCE(excluded.stream_format, tracks.stream_format),
+                           stream_expires = CASE WHEN excluded.stream_url IS NULL
+                                                 THEN tracks.stream_expires ELSE excluded.stream_expires END,
+                           acodec = CASE WHEN excluded.stream_url IS NULL THEN tracks.acodec ELSE excluded.acodec END,
+                           abr = CASE WHEN excluded.stream_url IS NULL THEN tracks.abr ELSE excluded.abr END,
+                           updated_at = excluded.updated_at""",
+                    [(t["id"], t["title"], t["duration"], t["webpage_url"], t["stream_url"],
+                      t["stream_format"], t["stream_expires"], now, t["acodec"], t["abr"]) for t in tracks],
+                )
+                db.execute(
+                    "INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?, ?)",
+                    (key, kind, entry["title"], json.dumps(entry["ids"]), now),
+                )
+
+    def stats(self):
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "queries": len(self._queries),
+            "tracks": len(self._tracks),
+        }
+
+
+EXTRACT_CACHE = ExtractionCache(EXTRACT_CACHE_PATH, EXTRACT_CACHE_SIZE)
+
+
+# Configuración del motor de extracción
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "4"))
+# "thread": yt-dlp en hilos de este proceso; "process": en procesos aparte, para no competir
+# por el GIL con el event loop que envía el audio
+EXTRACT_MODE = os.getenv("EXTRACT_MODE", "thread")
+# Discord permite responder a una interacción diferida durante 15 minutos
+INTERACTION_TIMEOUT = 15 * 60
+
+
+# yt-dlp tarda en importarse: se carga con la primera extracción o en segundo plano al arrancar
+_YTDLP_LOCK = threading.Lock()
+_YOUTUBE_DL = None
+
+
+def load_ytdlp():
+    """Devuelve yt_dlp.YoutubeDL, importándolo la primera vez."""
+    global _YOUTUBE_DL
+    if _YOUTUBE_DL is None:
+        with _YTDLP_LOCK:
+            if _YOUTUBE_DL is None:
+                import yt_dlp
+                _YOUTUBE_DL = yt_dlp.YoutubeDL
+    return _YOUTUBE_DL
+
+
+class ExtractionCancelled(Exception):
+    """La petición de extracción se abandonó porque su interacción ya caducó."""
+
+
+class ExtractionEngine:
+    """Pool dedicado de hilos para yt-dlp.
+
+    Cada hilo mantiene instancias de YoutubeDL ya construidas por cada perfil de
+    opciones, así que solo la primera extracción de un perfil paga el arranque.
+    """
+
+    def __init__(self, max_workers, ydl_factory=None):
+        self.max_workers = max_workers
+        # Permite sustituir yt_dlp.YoutubeDL (p. ej. por un extractor falso en benchmark.py);
+        # sin él se usa yt-dlp, que se importa al necesitarlo
+        self.ydl_factory = ydl_factory
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ytdlp")
+        self._slots = None
+        self._local = threading.local()
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.cancelled = 0
+
+    def _get_ydl(self, ydl_opts):
+        profiles = getattr(self._local, "profiles", None)
+        if profiles is None:
+            profiles = self._local.profiles = {}
+        profile = json.dumps(ydl_opts, sort_keys=True)
+        ydl = profiles.get(profile)
+        if ydl is None:
+            factory = self.ydl_factory or load_ytdlp()
+            ydl = profiles[profile] = factory(ydl_opts)
+        return ydl
+
+    async def warm_up(self):
+        """Importa yt-dlp en el pool, sin bloquear el event loop, antes de la primera extracción."""
+        if self.ydl_factory is None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, load_ytdlp)
+
+    def run(self, query, ydl_opts):
+        """Extrae la información usando la instancia caliente del hilo actual."""
+        return self._get_ydl(ydl_opts).extract_info(query, download=False)
+
+    def stream(self, query, ydl_opts, batch_size, emit, stop):
+        """Recorre las entradas de una lista sin procesarlas todas de golpe.
+
+        Con process=False yt-dlp devuelve las entradas como un generador que va
+        pidiendo las páginas de la lista a medida que se consumen.
+        """
+        ydl = self._get_ydl(ydl_opts)
+        info = ydl.extract_info(query, download=False, process=False)
+        # Seguir las redirecciones (p. ej. de un vídeo con &list= a la lista)
+        for _ in range(3):
+            if info.get("_type") not in ("url", "url_transparent"):
+                break
+            info = ydl.extract_info(info["url"], download=False, ie_key=info.get("ie_key"), process=False)
+        emit(("title", info.get("title")))
+        entries = info.get("entries")
+        if entries is None:
+            emit(("batch", [info]))
+            return
+        batch = []
+        first = True
+        for entry in entries:
+            if stop.is_set():
+                return
+            if not entry:
+                continue
+            batch.append(entry)
+            # La primera entrada sale sola para empezar a reproducir cuanto antes
+            if first or len(batch) >= batch_size:
+                emit(("batch", batch))
+                batch = []
+                first = False
+        if batch:
+            emit(("batch", batch))
+
+    async def _acquire(self, query, deadline):
+        # El semáforo limita la concurrencia; quien espera cuenta como cola pendiente
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+        self.waiting += 1
+        try:
+            if deadline is None:
+                await self._slots.acquire()
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise asyncio.TimeoutError
+                await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.cancelled += 1
+            raise ExtractionCancelled(query) from None
+        finally:
+            self.waiting -= 1
+        self.running += 1
+
+    def _release(self):
+        self.running -= 1
+        self.completed += 1
+        self._slots.release()
+
+    async def _call(self, query, ydl_opts):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.run, query, ydl_opts)
+
+    async def extract(self, query, ydl_opts, deadline=None):
+        await self._acquire(query, deadline)
+        try:
+            return await self._call(query, ydl_opts)
+        finally:
+            self._release()
+
+    async def _start_stream(self, query, ydl_opts, batch_size, items):
+        """Lanza el recorrido de la lista; devuelve (future del trabajo, función para pararlo)."""
+        loop = asyncio.get_running_loop()
+        stop = threading.Event()
+
+        def emit(item):
+            loop.call_soon_threadsafe(items.put_nowait, item)
+
+        def work():
+            try:
+                self.stream(query, ydl_opts, batch_size, emit, stop)
+            except Exception as e:
+                emit(("error", e))
+            else:
+                emit(("done", None))
+
+        return loop.run_in_executor(self._executor, work), stop.set
+
+    async def stream_entries(self, query, ydl_opts, batch_size, deadline=None):
+        """Generador asíncrono de lotes (título de la lista, [entradas])."""
+        await self._acquire(query, deadline)
+        items = asyncio.Queue()
+        try:
+            future, stop = await self._start_stream(query, ydl_opts, batch_size, items)
+        except BaseException:
+            self._release()
+            raise
+        # El hueco del pool se libera cuando el trabajo termina, aunque se deje de consumir antes
+        future.add_done_callback(lambda _: self._release())
+        try:
+            title = None
+            while True:
+                kind, value = await items.get()
+                if kind == "title":
+                    title = value
+                elif kind == "batch":
+                    yield title, value
+                elif kind == "error":
+                    raise value
+                else:
+                    break
+        finally:
+            stop()
+
+    def stats(self):
+        return {
+            "mode": "thread",
+            "workers": self.max_workers,
+            "queue_depth": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+        }
+
+
+# Campos de la info de yt-dlp que cruzan entre procesos
+TRIMMED_FIELDS = ("_type", "ie_key", "id", "title", "duration", "webpage_url", "url", "acodec", "abr")
+
+
+def trim_info(info):
+    """Copia reducida de la info de yt-dlp, pequeña y serializable con pickle."""
+    trimmed = {field: info[field] for field in TRIMMED_FIELDS if info.get(field) is not None}
+    entries = info.get("entries")
+    if entries is not None:
+        trimmed["entries"] = [trim_info(entry) if entry else None for entry in entries]
+    return trimmed
+
+
+# Motor propio de cada proceso de extracción (solo existe dentro de esos procesos)
+_WORKER_ENGINE = None
+
+
+def _init_extract_worker(ydl_factory):
+    global _WORKER_ENGINE
+    _WORKER_ENGINE = ExtractionEngine(1, ydl_factory)
 
-def _extract(query, ydl_opts):
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        return ydl.extract_info(query, download=False)
+
+def _warm_extract_worker():
+    load_ytdlp()
+
+
+def _process_run(query, ydl_opts):
+    return trim_info(_WORKER_ENGINE.run(query, ydl_opts))
+
+
+def _process_stream(query, ydl_opts, batch_size, items, stop):
+    def emit(item):
+        kind, value = item
+        if kind == "batch":
+            value = [trim_info(entry) for entry in value]
+        items.put((kind, value))
+
+    try:
+        _WORKER_ENGINE.stream(query, ydl_opts, batch_size, emit, stop)
+    except Exception as e:
+        # Las excepciones de yt-dlp no siempre se pueden serializar
+        items.put(("error", RuntimeError(str(e))))
+    else:
+        items.put(("done", None))
+
+
+class ProcessExtractionEngine(ExtractionEngine):
+    """Igual que ExtractionEngine, pero yt-dlp se ejecuta en procesos aparte.
+
+    Cada proceso mantiene sus propias instancias calientes de YoutubeDL y solo
+    devuelve la info recortada con trim_info. Las listas se van enviando por
+    lotes a través de una cola de multiprocessing.
+    """
+
+    def __init__(self, max_workers, ydl_factory=None):
+        super().__init__(max_workers, ydl_factory)
+        self._executor.shutdown(wait=False)
+        # "spawn" también en Linux: hacer fork de un proceso con hilos en marcha no es seguro
+        self._context = multiprocessing.get_context("spawn")
+        self._executor = self._new_pool()
+        self._manager = None
+        self.restarts = 0
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=self._context,
+            initializer=_init_extract_worker, initargs=(self.ydl_factory,),
+        )
+
+    def _replace_broken_pool(self, pool):
+        # Un proceso que muere (p. ej. sin memoria) inutiliza todo el pool
+        if self._executor is pool:
+            self.restarts += 1
+            self._executor = self._new_pool()
+
+    async def _call(self, query, ydl_opts):
+        loop = asyncio.get_running_loop()
+        pool = self._executor
+        try:
+            return await loop.run_in_executor(pool, _process_run, query, ydl_opts)
+        except BrokenProcessPool:
+            self._replace_broken_pool(pool)
+            raise
+
+    async def _start_stream(self, query, ydl_opts, batch_size, items):
+        loop = asyncio.get_running_loop()
+        if self._manager is None:
+            self._manager = await loop.run_in_executor(None, self._context.Manager)
+        remote = self._manager.Queue()
+        stop = self._manager.Event()
+        pool = self._executor
+        future = loop.run_in_executor(pool, _process_stream, query, ydl_opts, batch_size, remote, stop)
+
+        def forward():
+            # Pasa los lotes de la cola del proceso a la cola asyncio
+            while True:
+                item = remote.get()
+                if item[0] == "closed":
+                    return
+                loop.call_soon_threadsafe(items.put_nowait, item)
+                if item[0] in ("done", "error"):
+                    return
+
+        def finished(done):
+            error = None if done.cancelled() else done.exception()
+            if error is not None:
+                if isinstance(error, BrokenProcessPool):
+                    self._replace_broken_pool(pool)
+                items.put_nowait(("error", error))
+            # Desbloquear forward() si el proceso murió sin avisar
+            loop.run_in_executor(None, remote.put, ("closed", None))
+
+        loop.run_in_executor(None, forward)
+        future.add_done_callback(finished)
+        return future, lambda: loop.run_in_executor(None, stop.set)
+
+    async def warm_up(self):
+        # Arranca los procesos del pool, que importan yt-dlp cada uno por su cuenta
+        if self.ydl_factory is None:
+            loop = asyncio.get_running_loop()
+            pool = self._executor
+            try:
+                await asyncio.gather(*(
+                    loop.run_in_executor(pool, _warm_extract_worker) for _ in range(self.max_workers)
+                ))
+            except BrokenProcessPool:
+                self._replace_broken_pool(pool)
+                raise
+
+    def stats(self):
+        stats = super().stats()
+        stats["mode"] = "process"
+        stats["restarts"] = self.restarts
+        return stats
+
+
+if EXTRACT_MODE == "process":
+    EXTRACT_ENGINE = ProcessExtractionEngine(EXTRACT_WORKERS)
+else:
+    EXTRACT_ENGINE = ExtractionEngine(EXTRACT_WORKERS)
+
+
+def interaction_deadline(interaction):
+    """Instante (time.monotonic) a partir del cual ya no se puede responder a la interacción."""
+    age = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+    return time.monotonic() + INTERACTION_TIMEOUT - age
+
+
+class SingleFlight:
+    """Agrupa las llamadas concurrentes con la misma clave en una sola ejecución.
+
+    La primera llamada lanza el trabajo y las que llegan mientras sigue en curso
+    esperan ese mismo resultado (o excepción).
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.leaders = 0
+        self.collapsed = 0
+
+    def _finished(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        # Evitar el aviso de "exception was never retrieved" si todos dejaron de esperar
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, factory):
+        """Devuelve (resultado, compartido); compartido es True si se reutilizó otra llamada."""
+        task = self._flights.get(key)
+        shared = task is not None
+        if shared:
+            self.collapsed += 1
+        else:
+            self.leaders += 1
+            task = self._flights[key] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda done: self._finished(key, done))
+        # shield: si quien espera se cancela, el trabajo sigue para los demás
+        return await asyncio.shield(task), shared
+
+    def stats(self):
+        return {"leaders": self.leaders, "collapsed": self.collapsed, "in_flight": len(self._flights)}
+
+
+# Extracciones en curso, por búsqueda normalizada y perfil de opciones
+EXTRACT_FLIGHTS = SingleFlight()
+
+
+async def _extract_uncached(query, ydl_opts, deadline):
+    """Lee la caché en disco o extrae con yt-dlp. Devuelve (resultados, origen)."""
+    loop = asyncio.get_running_loop()
+    results = await loop.run_in_executor(None, lambda: EXTRACT_CACHE.get_disk(query, ydl_opts))
+    if results is not None:
+        return results, "disk"
+    started = time.monotonic()
+    results = await EXTRACT_ENGINE.extract(query, ydl_opts, deadline)
+    log_event("extract", query=query, seconds=round(time.monotonic() - started, 3))
+    try:
+        await loop.run_in_executor(None, lambda: EXTRACT_CACHE.put(query, ydl_opts, results))
+    except sqlite3.Error as e:
+        print(f"Error al guardar en la caché de extracción: {e}")
+    return results, "extractor"
+
+
+async def cached_extract(query, ydl_opts, deadline=None, site="other"):
+    """Consulta la caché (memoria y disco) antes de lanzar una extracción real.
+
+    Las peticiones idénticas simultáneas comparten una sola extracción. site
+    identifica quién la pide ("play", "recommendations"...) en las métricas.
+    """
+    started = time.monotonic()
+    results = EXTRACT_CACHE.get_memory(query, ydl_opts)
+    if results is not None:
+        METRICS.observe("musicbot_extract_seconds", time.monotonic() - started, site=site, source="memory")
+        return results
+    key = (normalize_query(query), json.dumps(ydl_opts, sort_keys=True))
+    while True:
+        try:
+            (results, source), shared = await EXTRACT_FLIGHTS.do(
+                key, lambda: _extract_uncached(query, ydl_opts, deadline)
+            )
+            break
+        except ExtractionCancelled:
+            # La extracción compartida caducó con el plazo de otra interacción: reintentar si el nuestro sigue vigente
+            if deadline is not None and deadline <= time.monotonic():
+                raise
+    if shared:
+        source = "shared"
+    METRICS.observe("musicbot_extract_seconds", time.monotonic() - started, site=site, source=source)
+    return results
+
+
+async def search_ytdlp_async(query, ydl_opts, deadline=None, site="other"):
+    return await cached_extract(query, ydl_opts, deadline, site)
 
 # Función para extraer información de una sola canción
-async def extract_single_song(url, ydl_opts):
+async def extract_single_song(url, ydl_opts, deadline=None, site="other"):
+    return await cached_extract(url, ydl_opts, deadline, site)
+
+# Tamaño de los lotes al añadir una lista de reproducción a la cola
+PLAYLIST_BATCH_SIZE = int(os.getenv("PLAYLIST_BATCH_SIZE", "25"))
+# Cada cuántos segundos se actualiza el mensaje de progreso de una lista
+PLAYLIST_PROGRESS_INTERVAL = 2.0
+
+PLAYLIST_URL_RE = re.compile(r"[?&]list=|/playlist|/channel/|/@|/c/|/user/")
+
+
+def is_playlist_url(url):
+    return PLAYLIST_URL_RE.search(url) is not None
+
+
+async def stream_playlist(url, ydl_opts, deadline=None):
+    """Genera lotes (título, entradas) de una lista, usando la caché si está disponible."""
+    loop = asyncio.get_running_loop()
+    results = EXTRACT_CACHE.get_memory(url, ydl_opts)
+    if results is None:
+        results = await loop.run_in_executor(None, lambda: EXTRACT_CACHE.get_disk(url, ydl_opts))
+    if results is not None:
+        entries = results.get("entries", [results])
+        for start in range(0, len(entries), PLAYLIST_BATCH_SIZE):
+            yield results.get("title"), entries[start:start + PLAYLIST_BATCH_SIZE]
+        return
+
+    title = None
+    collected = []
+    started = time.monotonic()
+    async for title, batch in EXTRACT_ENGINE.stream_entries(url, ydl_opts, PLAYLIST_BATCH_SIZE, deadline):
+        if not collected:
+            # Para una lista lo que cuenta es cuánto tarda el primer lote
+            METRICS.observe("musicbot_extract_seconds", time.monotonic() - started, site="playlist", source="extractor")
+        collected.extend(batch)
+        yield title, batch
+    # Solo se guarda en caché la lista completa
+    try:
+        await loop.run_in_executor(
+            None, lambda: EXTRACT_CACHE.put(url, ydl_opts, {"title": title, "entries": collected})
+        )
+    except sqlite3.Error as e:
+        print(f"Error al guardar en la caché de extracción: {e}")
+
+
+# Opciones comunes para yt-dlp
+YDL_OPTIONS = {
+    "format": "bestaudio[abr<=96]/bestaudio",
+    "noplaylist": False,  # Permitir listas de reproducción
+    "youtube_include_dash_manifest": False,
+    "youtube_include_hls_manifest": False,
+    "extractor_args": {
+        "youtube": {
+            "formats": "missing_pot"
+        }
+    }
+}
+
+# Las listas y las recomendaciones solo necesitan metadatos; el audio se resuelve al reproducir
+FLAT_YDL_OPTIONS = {**YDL_OPTIONS, "extract_flat": "in_playlist"}
+
+# Para resolver el audio de una canción concreta de la cola
+STREAM_YDL_OPTIONS = {**YDL_OPTIONS, "noplaylist": True}
+
+
+class Track:
+    """Entrada de la cola: referencia ligera a una canción.
+
+    La URL de audio firmada se obtiene justo antes de reproducirla y se vuelve
+    a resolver si ha caducado mientras esperaba en la cola.
+    """
+
+    __slots__ = (
+        "video_id", "title", "duration", "webpage_url", "stream_url", "expires_at", "acodec", "abr", "requested_at",
+        "recommended", "failures", "start_at",
+    )
+
+    def __init__(self, video_id, title, duration=None, webpage_url=None, stream_url=None, expires_at=0.0):
+        self.video_id = video_id
+        self.title = title
+        self.duration = duration
+        self.webpage_url = webpage_url
+        self.stream_url = stream_url
+        self.expires_at = expires_at
+        # Códec y bitrate del formato elegido por yt-dlp, para decidir si hace falta recodificar
+        self.acodec = None
+        self.abr = None
+        # Momento (time.monotonic) del /play que la pidió, hasta que empieza a sonar
+        self.requested_at = None
+        # Añadida por las recomendaciones y no por un usuario
+        self.recommended = False
+        # Intentos fallidos de reproducirla
+        self.failures = 0
+        # Segundo desde el que debe empezar la próxima vez que suene (/seek o tras un corte)
+        self.start_at = 0.0
+
+    @classmethod
+    def from_info(cls, info):
+        """Crea la entrada a partir de la info de yt-dlp (completa o "flat")."""
+        video_id = info.get("id")
+        webpage_url = info.get("webpage_url")
+        stream_url = None
+        if info.get("_type", "video") == "url":
+            webpage_url = webpage_url or info.get("url")
+        else:
+            stream_url = info.get("url")
+        if not webpage_url and video_id:
+            webpage_url = f"https://www.youtube.com/watch?v={video_id}"
+        track = cls(video_id, info.get("title") or "Untitled", info.get("duration"), webpage_url)
+        if stream_url:
+            track.set_stream(stream_url, info.get("acodec"), info.get("abr"))
+        return track
+
+    def set_stream(self, stream_url, acodec=None, abr=None):
+        self.stream_url = stream_url
+        self.expires_at = stream_url_expiry(stream_url)
+        self.acodec = acodec
+        self.abr = abr
+
+    def stream_valid(self):
+        return self.stream_url is not None and self.expires_at > time.time()
+
+
+async def resolve_stream(track, profile=None):
+    """Devuelve una URL de audio válida para la canción, resolviéndola si hace falta.
+
+    Con un perfil de calidad se usa su selector de formato.
+    """
+    if track.stream_valid():
+        return track.stream_url
+    ydl_opts = profile.ydl_options if profile is not None else STREAM_YDL_OPTIONS
+    info = await extract_single_song(track.webpage_url, ydl_opts, site="stream")
+    if not info or not info.get("url"):
+        raise ValueError(f"No se pudo obtener el audio de {track.webpage_url}")
+    track.set_stream(info["url"], info.get("acodec"), info.get("abr"))
+    if info.get("duration"):
+        track.duration = info["duration"]
+    return track.stream_url
+
+
+# Límite de mensajes por canal que aplica Discord: CHANNEL_RATE envíos cada CHANNEL_PER segundos
+CHANNEL_RATE = 5
+CHANNEL_PER = 5.0
+
+# Reacciones de control del mensaje "Now playing"
+CONTROL_REACTIONS = ["⏯️", "⏭️", "🔁", "🔀", "⏹️", "📋"]
+
+
+class _Outbound:
+    __slots__ = ("key", "action", "future")
+
+    def __init__(self, key, action, future):
+        self.key = key
+        self.action = action
+        self.future = future
+
+
+class OutboundDispatcher:
+    """Cola de mensajes salientes por canal.
+
+    Cada canal tiene su propia cola y su propio límite de ritmo, de modo que
+    un canal saturado no retrasa a los demás ni a la reproducción. Los envíos
+    con la misma clave que aún no han salido se fusionan: solo se manda el
+    último.
+    """
+
+    def __init__(self, rate=CHANNEL_RATE, per=CHANNEL_PER):
+        self.rate = rate
+        self.per = per
+        self._queues = {}
+        self._workers = {}
+        # Envíos pendientes con clave: (canal, clave) -> _Outbound
+        self._keyed = {}
+        # Momentos de los últimos envíos de cada canal
+        self._sent_at = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        # Tareas sueltas (p. ej. reacciones): asyncio solo guarda referencias débiles
+        self._tasks = set()
+
+    def spawn(self, coro):
+        """Lanza una tarea en segundo plano manteniendo una referencia hasta que termine."""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def submit(self, channel, action, key=None):
+        """Encola action (una función que devuelve una corrutina) para el canal.
+
+        Devuelve un future con el resultado; no hace falta esperarlo.
+        """
+        pending = self._keyed.get((channel.id, key)) if key is not None else None
+        if pending is not None:
+            pending.action = action
+            self.coalesced += 1
+            return pending.future
+
+        op = _Outbound(key, action, asyncio.get_running_loop().create_future())
+        if key is not None:
+            self._keyed[(channel.id, key)] = op
+        self._queues.setdefault(channel.id, deque()).append(op)
+        if channel.id not in self._workers:
+            self._workers[channel.id] = asyncio.create_task(self._drain(channel.id))
+        return op.future
+
+    def send(self, channel, content=None, key=None, **kwargs):
+        """Encola un channel.send()."""
+        return self.submit(channel, lambda: channel.send(content, **kwargs), key=key)
+
+    async def _wait_turn(self, channel_id):
+        sent_at = self._sent_at.setdefault(channel_id, deque())
+        now = time.monotonic()
+        while sent_at and now - sent_at[0] >= self.per:
+            sent_at.popleft()
+        if len(sent_at) >= self.rate:
+            delay = self.per - (now - sent_at[0])
+            self.throttled += 1
+            self.throttled_seconds += delay
+            await asyncio.sleep(delay)
+            sent_at.popleft()
+        sent_at.append(time.monotonic())
+
+    async def _drain(self, channel_id):
+        queue = self._queues[channel_id]
+        try:
+            while queue:
+                op = queue.popleft()
+                await self._wait_turn(channel_id)
+                # A partir de aquí el envío ya no se puede fusionar
+                if op.key is not None:
+                    self._keyed.pop((channel_id, op.key), None)
+                try:
+                    result = await op.action()
+                    self.sent += 1
+                except Exception as e:
+                    print(f"Error al enviar mensaje: {e}")
+                    self.failed += 1
+                    result = None
+                if not op.future.done():
+                    op.future.set_result(result)
+        finally:
+            del self._queues[channel_id]
+            del self._workers[channel_id]
+            sent_at = self._sent_at.get(channel_id)
+            if not sent_at or time.monotonic() - sent_at[-1] >= self.per:
+                self._sent_at.pop(channel_id, None)
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+            "pending": sum(len(q) for q in self._queues.values()),
+            "throttled": self.throttled,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+        }
+
+
+DISPATCHER = OutboundDispatcher()
+
+
+async def add_control_reactions(message):
+    try:
+        for reaction in CONTROL_REACTIONS:
+            await message.add_reaction(reaction)
+    except discord.HTTPException as e:
+        print(f"Error al añadir reacciones: {e}")
+
+
+async def show_now_playing(player, channel, content):
+    message = player.now_playing_message
+    # Editar el mensaje anterior solo si sigue siendo el último del canal; si no, quedaría oculto
+    if (
+        message is not None
+        and message.channel.id == channel.id
+        and getattr(channel, "last_message_id", None) == message.id
+    ):
+        try:
+            await message.edit(content=content)
+            return message
+        except discord.NotFound:
+            pass
+    message = await channel.send(content)
+    player.now_playing_message = message
+    # Las reacciones se añaden una sola vez por mensaje y fuera de la cola del canal
+    DISPATCHER.spawn(add_control_reactions(message))
+    return message
+
+
+def announce_now_playing(player, channel, title):
+    """Muestra la canción actual sin esperar a Discord; los cambios rápidos se fusionan."""
+    DISPATCHER.submit(
+        channel,
+        lambda: show_now_playing(player, channel, f"Now playing: **{title}**"),
+        key=("now_playing", player.guild_id),
+    )
+
+
+# Configuración de las recomendaciones
+RECOMMENDATION_DB_PATH = os.getenv("RECOMMENDATION_DB_PATH", os.path.join("cache", "recommendations.sqlite3"))
+# Canciones que se añaden cada vez que la cola se queda vacía
+RECOMMENDATION_COUNT = 5
+# Se preparan recomendaciones cuando quedan estas canciones o menos en la cola
+RECOMMENDATION_LOOKAHEAD = 2
+# Canciones del historial que sirven de semilla en el índice local
+RECOMMENDATION_SEEDS = 3
+
+
+class RecommendationIndex:
+    """Índice local de co-ocurrencias: qué canciones suenan después de cada canción.
+
+    Se alimenta con las transiciones de todos los servidores (solo las elegidas
+    por usuarios) y se guarda en SQLite, así que la mayoría de recomendaciones
+    no necesitan consultar YouTube.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS transitions (
+                    prev_id TEXT NOT NULL,
+                    next_id TEXT NOT NULL,
+                    next_title TEXT,
+                    next_duration REAL,
+                    count INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (prev_id, next_id)
+                )
+            """)
+        return self._db
+
+    def record(self, prev_id, track):
+        """Anota que track sonó justo después de prev_id."""
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                """
+                INSERT INTO transitions (prev_id, next_id, next_title, next_duration, count, updated_at)
+                VALUES (?, ?, ?, ?, 1, ?)
+                ON CONFLICT(prev_id, next_id) DO UPDATE SET
+                    count = count + 1, next_title = excluded.next_title,
+                    next_duration = excluded.next_duration, updated_at = excluded.updated_at
+                """,
+                (prev_id, track.video_id, track.title, track.duration, time.time()),
+            )
+            db.commit()
+            self.recorded += 1
+
+    def lookup(self, seed_ids, exclude, limit):
+        """Canciones que más veces han seguido a las semillas, sin las de exclude."""
+        if not seed_ids:
+            return []
+        with self._lock:
+            rows = self._connect().execute(
+                f"""
+                SELECT next_id, next_title, next_duration, SUM(count) AS total FROM transitions
+                WHERE prev_id IN ({",".join("?" * len(seed_ids))})
+                GROUP BY next_id ORDER BY total DESC LIMIT ?
+                """,
+                (*seed_ids, limit + len(exclude)),
+            ).fetchall()
+        tracks = []
+        for video_id, title, duration, _ in rows:
+            if video_id in exclude:
+                continue
+            tracks.append(Track(video_id, title or "Untitled", duration, f"https://www.youtube.com/watch?v={video_id}"))
+            if len(tracks) >= limit:
+                break
+        if tracks:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return tracks
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "recorded": self.recorded}
+
+
+RECOMMENDATION_INDEX = RecommendationIndex(RECOMMENDATION_DB_PATH)
+
+
+def record_history(player, track):
+    """Guarda la canción en el historial del servidor y la transición en el índice."""
+    previous = player.last_track
+    player.last_track = track
+    if track.video_id is None:
+        return
+    if previous is not None and previous.video_id and previous.video_id != track.video_id and not track.recommended:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, RECOMMENDATION_INDEX.record, previous.video_id, track)
+        future.add_done_callback(_log_index_error)
+    if not player.history or player.history[-1] != track.video_id:
+        player.history.append(track.video_id)
+
+
+def _log_index_error(future):
+    if future.exception() is not None:
+        print(f"Error al guardar en el índice de recomendaciones: {future.exception()}")
+
+
+async def find_recommendations(player, seed, query=None):
+    """Busca canciones parecidas a seed (Track) o a query: primero en el índice local, luego en YouTube."""
+    exclude = set(player.history)
+    exclude.update(track.video_id for track in player.queue)
+    if seed is not None:
+        exclude.add(seed.video_id)
+    # Semillas: la canción de partida y las anteriores del historial
+    seeds = [seed.video_id] if seed is not None and seed.video_id else []
+    for video_id in reversed(player.history):
+        if len(seeds) >= RECOMMENDATION_SEEDS:
+            break
+        if video_id not in seeds:
+            seeds.append(video_id)
     loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: _extract_single(url, ydl_opts))
+    tracks = await loop.run_in_executor(None, RECOMMENDATION_INDEX.lookup, seeds, exclude, RECOMMENDATION_COUNT)
+
+    if len(tracks) < RECOMMENDATION_COUNT:
+        # Completar con una búsqueda de YouTube (usando el título de la canción)
+        query = seed.title if seed is not None else query
+        results = await search_ytdlp_async(
+            f"ytsearch{RECOMMENDATION_COUNT * 2}: {query} similar songs", FLAT_YDL_OPTIONS, site="recommendations"
+        )
+        exclude.update(track.video_id for track in tracks)
+        for info in results.get("entries", []):
+            if len(tracks) >= RECOMMENDATION_COUNT:
+                break
+            if not info:
+                continue
+            track = Track.from_info(info)
+            if track.webpage_url and track.video_id not in exclude:
+                exclude.add(track.video_id)
+                tracks.append(track)
+
+    for track in tracks:
+        track.recommended = True
+    return tracks
+
+
+async def prepare_recommendations(player, seed):
+    """Prepara en segundo plano las recomendaciones para cuando termine la cola."""
+    try:
+        tracks = await find_recommendations(player, seed)
+        player.recommended = (seed.video_id, tracks)
+        # Dejar resuelto el audio de la primera para empezar sin espera
+        if tracks:
+            await resolve_stream(tracks[0])
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Error al preparar recomendaciones: {e}")
+
+
+def schedule_recommendations(player):
+    """Lanza la preparación si quedan pocas canciones y la última de la cola ha cambiado."""
+    if not player.recommendations or player.loop_mode != "none" or len(player.queue) > RECOMMENDATION_LOOKAHEAD:
+        return
+    seed = player.queue[-1] if player.queue else player.last_track
+    if seed is None or not seed.video_id:
+        return
+    if player.recommended is not None and player.recommended[0] == seed.video_id:
+        return
+    task = player.recommend_task
+    if task is not None and not task.done():
+        task.cancel()
+    player.recommended = None
+    player.recommend_task = asyncio.create_task(prepare_recommendations(player, seed))
+
+
+async def take_recommendations(player):
+    """Devuelve las recomendaciones preparadas para la última canción, si las hay."""
+    # La preparación puede cancelarse y sustituirse mientras se espera (p. ej. /recommendations):
+    # entonces se espera a la nueva
+    task = player.recommend_task
+    while task is not None and not task.done():
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise  # Se ha cancelado quien espera, no la preparación
+        if player.recommend_task is task:
+            break
+        task = player.recommend_task
+    prepared, player.recommended = player.recommended, None
+    last = player.last_track
+    if prepared is None or last is None or prepared[0] != last.video_id:
+        return []
+    return prepared[1]
 
-def _extract_single(url, ydl_opts):
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        return ydl.extract_info(url, download=False)
 
 # Función para obtener recomendaciones basadas en una canción
 async def get_recommendations(voice_client, guild_id, channel, query):
-    # Opciones para yt-dlp
-    ydl_options = {
-        "format": "bestaudio[abr<=96]/bestaudio",
-        "noplaylist": False,
-        "youtube_include_dash_manifest": False,
-        "youtube_include_hls_manifest": False,
-        "extractor_args": {
-            "youtube": {
-                "formats": "missing_pot"
-            }
-        }
-    }
-    
-    # Buscar recomendaciones (usando la búsqueda de YouTube con el título de la canción)
-    search_query = f"ytsearch5: {query} similar songs"
+    player = get_player(guild_id)
     try:
-        results = await search_ytdlp_async(search_query, ydl_options)
-        tracks = results.get("entries", [])
-        
+        tracks = await take_recommendations(player)
         if not tracks:
-            await channel.send("No se encontraron recomendaciones.")
+            tracks = await find_recommendations(player, player.last_track, query)
+
+        if not tracks:
+            DISPATCHER.send(channel, "No se encontraron recomendaciones.")
             return
-        
-        # Crear la cola si no existe
-        if SONG_QUEUES.get(guild_id) is None:
-            SONG_QUEUES[guild_id] = deque()
-        
+
         # Añadir recomendaciones a la cola
-        added_count = 0
-        for track in tracks:
-            if track:
-                audio_url = track.get("url")
-                title = track.get("title", "Untitled")
-                if audio_url:
-                    SONG_QUEUES[guild_id].append((audio_url, title))
-                    added_count += 1
-        
-        # Informar al usuario
-        if added_count > 0:
-            await channel.send(f"Se han añadido {added_count} recomendaciones a la cola.")
-            
-            # Guardar la última canción reproducida para futuras recomendaciones
-            voice_client.last_played = query
-            
-            # Iniciar la reproducción
-            await play_next_song(voice_client, guild_id, channel)
-        else:
-            await channel.send("No se pudieron añadir recomendaciones a la cola.")
-    
+        player.queue.extend(tracks)
+        DISPATCHER.send(channel, f"Se han añadido {len(tracks)} recomendaciones a la cola.")
+
+        # Guardar la última canción reproducida para futuras recomendaciones
+        player.last_played = query
+
+        # Iniciar la reproducción
+        await play_next_song(voice_client, guild_id, channel)
+
     except Exception as e:
         print(f"Error al obtener recomendaciones: {e}")
-        await channel.send("Ocurrió un error al buscar recomendaciones.")
+        DISPATCHER.send(channel, "Ocurrió un error al buscar recomendaciones.")
+
+
+# Persistencia del estado de los reproductores (cola, bucle, recomendaciones)
+PERSIST_ENABLED = os.getenv("PERSIST_ENABLED", "1") == "1"
+PERSIST_PATH = os.getenv("PERSIST_PATH", os.path.join("cache", "state.sqlite3"))
+# Cada cuántos segundos se guardan los servidores que han cambiado
+PERSIST_INTERVAL = float(os.getenv("PERSIST_INTERVAL", "2"))
+# Cada cuántos segundos de reproducción se vuelve a guardar la posición de la canción actual
+PERSIST_POSITION_STEP = 15
+
+
+def track_to_row(track, start_at=0.0):
+    return [track.video_id, track.title, track.duration, track.webpage_url, track.recommended, round(start_at, 2)]
+
+
+def track_from_row(row):
+    track = Track(row[0], row[1], row[2], row[3])
+    track.recommended = bool(row[4])
+    # Filas guardadas antes de guardar la posición
+    if len(row) > 5:
+        track.start_at = row[5] or 0.0
+    return track
+
+
+class StateStore:
+    """Guarda el estado de los reproductores en SQLite para recuperarlo tras un reinicio.
+
+    Cada PERSIST_INTERVAL segundos se toma una instantánea de los servidores
+    cuyo estado ha cambiado y se escriben todas juntas desde un hilo aparte.
+    Los estados guardados se leen una vez al arrancar, también desde ese hilo,
+    y cada servidor se restaura de memoria la primera vez que se usa.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Un solo hilo: las escrituras se aplican en orden
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+        # Conexión del hilo de la base de datos
+        self._writer = None
+        # Estados leídos al arrancar que aún no se han restaurado
+        self._stored = {}
+        # Firma del último estado anotado de cada servidor
+        self._saved = {}
+        # Instantáneas pendientes de escribir y las que se están escribiendo (None = borrar)
+        self._pending = {}
+        self._writing = {}
+        self.writes = 0
+        self.batches = 0
+        self.restored = 0
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS players (
+                guild_id INTEGER PRIMARY KEY,
+                state TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        return db
+
+    @staticmethod
+    def _signature(player):
+        current = player.now_playing
+        last = player.last_track
+        return (
+            player.queue.version, player.loop_mode, player.recommendations,
+            current.video_id if current is not None else None, last.video_id if last is not None else None,
+            int(player.position() // PERSIST_POSITION_STEP),
+        )
+
+    @staticmethod
+    def _snapshot(player):
+        current = player.now_playing
+        tracks = list(player.queue)
+        # Con bucle, la canción actual ya está otra vez en la cola: se guarda solo como actual
+        if current is not None and tracks:
+            if player.loop_mode == "song" and tracks[0] is current:
+                tracks.pop(0)
+            elif player.loop_mode == "queue" and tracks[-1] is current:
+                tracks.pop()
+        if (
+            not tracks and current is None and player.loop_mode == "none"
+            and player.recommendations == RECOMMENDATIONS_ENABLED
+        ):
+            # Estado por defecto: no hace falta guardarlo
+            return None
+        position = player.position()
+        # Casi al final: al restaurarla vuelve a empezar en lugar de sonar unos segundos
+        if current is not None and current.duration and position >= current.duration - STREAM_CUT_MARGIN:
+            position = 0.0
+        return {
+            "loop_mode": player.loop_mode,
+            "recommendations": player.recommendations,
+            "last_played": player.last_played,
+            "history": list(player.history),
+            "current": track_to_row(current, position) if current is not None else None,
+            "queue": [track_to_row(track) for track in tracks],
+        }
+
+    def collect(self, players):
+        """Toma instantáneas de los servidores que han cambiado desde la última vez."""
+        for player in players:
+            signature = self._signature(player)
+            if self._saved.get(player.guild_id) != signature:
+                self._saved[player.guild_id] = signature
+                self._pending[player.guild_id] = self._snapshot(player)
+
+    def forget(self, player):
+        """Guarda el estado final de un reproductor que se va a liberar."""
+        self._saved.pop(player.guild_id, None)
+        self._pending[player.guild_id] = self._snapshot(player)
+
+    def _write(self, batch):
+        if self._writer is None:
+            self._writer = self._open()
+        now = time.time()
+        with self._writer:
+            for guild_id, state in batch.items():
+                if state is None:
+                    self._writer.execute("DELETE FROM players WHERE guild_id = ?", (guild_id,))
+                else:
+                    self._writer.execute(
+                        "INSERT OR REPLACE INTO players (guild_id, state, updated_at) VALUES (?, ?, ?)",
+                        (guild_id, json.dumps(state), now),
+                    )
+        self.writes += len(batch)
+        self.batches += 1
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        self._writing = batch
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._write, batch)
+        except sqlite3.Error as e:
+            print(f"Error al guardar el estado de los reproductores: {e}")
+            # Reintentar en la siguiente pasada, salvo lo que ya se haya vuelto a anotar
+            for guild_id, state in batch.items():
+                self._pending.setdefault(guild_id, state)
+        finally:
+            self._writing = {}
+
+    async def run(self):
+        """Guarda periódicamente los cambios de todos los reproductores."""
+        while True:
+            await asyncio.sleep(PERSIST_INTERVAL)
+            self.collect(PLAYERS.values())
+            await self.flush()
+
+    def _read_all(self, owns_guild):
+        if self._writer is None:
+            self._writer = self._open()
+        states = {}
+        for guild_id, state in self._writer.execute("SELECT guild_id, state FROM players"):
+            if owns_guild(guild_id):
+                try:
+                    states[guild_id] = json.loads(state)
+                except ValueError as e:
+                    print(f"Estado guardado no válido para el servidor {guild_id}: {e}")
+        return states
+
+    async def preload(self, owns_guild=lambda guild_id: True):
+        """Lee los estados guardados de los servidores de este proceso, sin bloquear el event loop."""
+        loop = asyncio.get_running_loop()
+        try:
+            self._stored = await loop.run_in_executor(self._executor, self._read_all, owns_guild)
+        except sqlite3.Error as e:
+            print(f"Error al leer el estado guardado de los reproductores: {e}")
+
+    def load(self, guild_id):
+        # Lo que aún no se ha escrito es más reciente que lo leído al arrancar
+        for states in (self._pending, self._writing):
+            if guild_id in states:
+                self._stored.pop(guild_id, None)
+                return states[guild_id]
+        return self._stored.pop(guild_id, None)
+
+    def restore(self, player):
+        """Recupera el estado guardado del servidor en un reproductor recién creado."""
+        state = self.load(player.guild_id)
+        if not state:
+            return
+        player.loop_mode = state["loop_mode"]
+        player.recommendations = state["recommendations"]
+        player.last_played = state.get("last_played")
+        player.history.extend(state.get("history", []))
+        tracks = [track_from_row(row) for row in state["queue"]]
+        # La canción que sonaba continúa por donde iba
+        if state.get("current"):
+            tracks.insert(0, track_from_row(state["current"]))
+        player.queue.extend(tracks)
+        self.restored += 1
+
+    def shutdown(self, players):
+        """Guarda lo pendiente antes de salir, con la posición exacta de cada canción."""
+        for player in players:
+            self._pending[player.guild_id] = self._snapshot(player)
+        if self._pending:
+            batch, self._pending = self._pending, {}
+            try:
+                self._executor.submit(self._write, batch).result()
+            except sqlite3.Error as e:
+                print(f"Error al guardar el estado de los reproductores: {e}")
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        return {"writes": self.writes, "batches": self.batches, "pending": len(self._pending), "restored": self.restored}
+
+
+STATE_STORE = StateStore(PERSIST_PATH) if PERSIST_ENABLED else None
+
+
+def restore_player_state(player):
+    if STATE_STORE is not None:
+        STATE_STORE.restore(player)
+
+
+def save_player_state(player):
+    if STATE_STORE is not None:
+        STATE_STORE.forget(player)
+
+
+PLAYER_CREATED_HOOKS.append(restore_player_state)
+PLAYER_EVICTED_HOOKS.append(save_player_state)
 
 
 # Setup of intents. Intents are permissions the bot has on the server
 intents = discord.Intents.default()
 intents.message_content = True
 
+
+def parse_shard_ids(value):
+    """Convierte "0,1,2" o "0-3" en una lista de IDs de shard."""
+    if not value:
+        return None
+    shard_ids = []
+    for part in value.split(","):
+        part = part.strip()
+        if "-" in part:
+            first, last = part.split("-", 1)
+            shard_ids.extend(range(int(first), int(last) + 1))
+        elif part:
+            shard_ids.append(int(part))
+    return shard_ids
+
+
+# Sharding: SHARD_COUNT es el total de shards del bot y SHARD_IDS los que atiende este proceso.
+# launcher.py reparte los shards entre varios procesos y rellena estas variables.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = parse_shard_ids(os.getenv("SHARD_IDS"))
+# Puerto local para health checks y estadísticas (0 = desactivado)
+CONTROL_PORT = int(os.getenv("CONTROL_PORT", "0"))
+
 # Bot setup
-bot = commands.Bot(command_prefix="!", intents=intents)
+if SHARD_COUNT or SHARD_IDS:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
+
+# Tarea que libera los reproductores inactivos
+PLAYER_SWEEPER = None
+# Servidor del canal de control local
+CONTROL_SERVER = None
+# Endpoint de métricas y medición del retraso del event loop
+METRICS_SERVER = None
+LOOP_LAG_MONITOR = None
+# Tarea que guarda el estado de los reproductores
+STATE_WRITER = None
+# Tarea que mide los recursos de ffmpeg
+FFMPEG_MONITOR = None
+
+
+def collect_stats():
+    """Estadísticas de este proceso, para el canal de control."""
+    return {
+        "guilds": len(bot.guilds),
+        "players": len(PLAYERS),
+        "voice_clients": len(bot.voice_clients),
+        "queued_tracks": sum(len(player.queue) for player in PLAYERS.values()),
+        "extract_cache": EXTRACT_CACHE.stats(),
+        "extract_engine": EXTRACT_ENGINE.stats(),
+        "single_flight": EXTRACT_FLIGHTS.stats(),
+        "recommendation_index": RECOMMENDATION_INDEX.stats(),
+        "state_store": STATE_STORE.stats() if STATE_STORE is not None else None,
+        "dispatcher": DISPATCHER.stats(),
+        "audio_cache": AUDIO_CACHE.stats() if AUDIO_CACHE is not None else None,
+        "ffmpeg": FFMPEG_MANAGER.stats(),
+        "quality": QUALITY_POLICY.stats(),
+        "startup": dict(STARTUP_PHASES),
+    }
 
-# Bot ready-up code
-@bot.event
-async def on_ready():
-    # Sincronización automática de comandos al iniciar el bot
+
+def metric_gauges():
+    """Valores instantáneos para el endpoint de métricas."""
+    gauges = []
+
+    def flatten(prefix, values):
+        for key, value in values.items():
+            if isinstance(value, dict):
+                flatten(f"{prefix}_{key}", value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                gauges.append((f"{prefix}_{key}", {}, value))
+
+    flatten("musicbot", collect_stats())
+    # Antes de conectar, bot.latency vale nan o inf
+    latency = bot.latency
+    if latency == latency and latency != float("inf"):
+        gauges.append(("musicbot_gateway_latency_seconds", {}, round(latency, 6)))
+    for guild_id, player in PLAYERS.items():
+        gauges.append(("musicbot_guild_queue_tracks", {"guild": guild_id}, len(player.queue)))
+    return gauges
+
+
+async def handle_metrics(reader, writer):
+    """Endpoint HTTP mínimo: GET /metrics devuelve el texto de Prometheus."""
+    try:
+        request = await reader.readline()
+        # Descartar las cabeceras
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request.decode(errors="replace").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status = "200 OK"
+            body = METRICS.render(metric_gauges()).encode()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            status = "404 Not Found"
+            body = b"not found\n"
+            content_type = "text/plain"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def collect_health():
+    shards = {}
+    if isinstance(bot, commands.AutoShardedBot):
+        for shard_id, shard in bot.shards.items():
+            shards[shard_id] = {"latency": shard.latency, "closed": shard.is_closed()}
+    return {
+        "ready": bot.is_ready(),
+        "closed": bot.is_closed(),
+        "latency": bot.latency,
+        "shard_count": bot.shard_count,
+        "shards": shards,
+    }
+
+
+async def handle_control(reader, writer):
+    """Canal de control: una orden por línea ("health" o "stats"), una respuesta JSON por línea."""
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode().strip()
+            if command == "health":
+                reply = collect_health()
+            elif command == "stats":
+                reply = collect_stats()
+            else:
+                reply = {"error": f"orden desconocida: {command}"}
+            writer.write(json.dumps(reply, default=str).encode() + b"\n")
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+def owns_guild(guild_id):
+    """Si el servidor corresponde a los shards de este proceso."""
+    if SHARD_IDS is None or not SHARD_COUNT:
+        return True
+    return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+
+def syncs_commands():
+    """Con varios procesos solo sincroniza los comandos el que tiene el shard 0."""
+    return SHARD_IDS is None or 0 in SHARD_IDS
+
+
+# Hash de los comandos sincronizados por última vez, por aplicación
+COMMAND_HASH_PATH = os.getenv("COMMAND_HASH_PATH", os.path.join("cache", "commands.json"))
+COMMAND_SYNC = None
+YTDLP_WARMUP = None
+
+
+def command_tree_hash():
+    """Hash de la definición de los comandos tal como se envían a Discord."""
+    payloads = []
+    for command in bot.tree.get_commands():
+        try:
+            payloads.append(command.to_dict(bot.tree))
+        except TypeError:
+            # discord.py < 2.4: to_dict() no recibe el árbol
+            payloads.append(command.to_dict())
+    payloads.sort(key=lambda payload: payload["name"])
+    return hashlib.sha256(json.dumps(payloads, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_command_hashes():
+    try:
+        with open(COMMAND_HASH_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_command_hashes(hashes):
+    directory = os.path.dirname(COMMAND_HASH_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = COMMAND_HASH_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(hashes, f)
+    os.replace(tmp_path, COMMAND_HASH_PATH)
+
+
+async def sync_commands(force=False):
+    """Sincroniza los comandos globales solo si han cambiado desde la última vez.
+
+    La sincronización global tiene un límite de uso estricto; devuelve None si
+    no hacía falta.
+    """
+    digest = command_tree_hash()
+    key = str(bot.application_id)
+    hashes = load_command_hashes()
+    if not force and hashes.get(key) == digest:
+        return None
+    synced = await bot.tree.sync()
+    hashes[key] = digest
+    try:
+        save_command_hashes(hashes)
+    except OSError as e:
+        print(f"Error al guardar el hash de los comandos: {e}")
+    return synced
+
+
+async def sync_commands_at_startup():
     try:
-        commands = await bot.tree.sync()
-        print(f"Sincronizados {len(commands)} comandos automáticamente")
+        synced = await sync_commands()
     except Exception as e:
         print(f"Error al sincronizar comandos: {e}")
+        return
+    if synced is None:
+        print("Los comandos no han cambiado; no se sincronizan")
+    else:
+        print(f"Sincronizados {len(synced)} comandos automáticamente")
+    mark_startup("command_sync")
+
+
+async def warm_up_ytdlp():
+    try:
+        await EXTRACT_ENGINE.warm_up()
+    except Exception as e:
+        print(f"Error al precargar yt-dlp: {e}")
+        return
+    mark_startup("ytdlp_import")
+
+
+SHUTDOWN_TASK = None
+
+
+def request_shutdown():
+    """Cierra el bot para que bot.run() vuelva y se guarde el estado antes de salir."""
+    global SHUTDOWN_TASK
+    if SHUTDOWN_TASK is None:
+        print("Señal de parada recibida, cerrando el bot...")
+        SHUTDOWN_TASK = asyncio.create_task(bot.close())
+
+
+def install_shutdown_handler():
+    # launcher.py, systemd y docker paran el proceso con SIGTERM; sin esto bot.run() no vuelve
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, request_shutdown)
+    except NotImplementedError:
+        # Windows: el event loop no admite señales
+        signal.signal(signal.SIGTERM, lambda signum, frame: loop.call_soon_threadsafe(request_shutdown))
+
+
+async def setup_hook():
+    # Se llama tras el login, antes de conectar con el gateway
+    mark_startup("login")
+    # El canal de control se abre antes de conectar, para que el launcher vea el arranque
+    global CONTROL_SERVER, METRICS_SERVER, LOOP_LAG_MONITOR, STATE_WRITER, FFMPEG_MONITOR
+    global COMMAND_SYNC, YTDLP_WARMUP
+    if CONTROL_PORT:
+        CONTROL_SERVER = await asyncio.start_server(handle_control, "127.0.0.1", CONTROL_PORT)
+    if METRICS_PORT:
+        # Las métricas son opcionales: un puerto ocupado no debe impedir el arranque
+        try:
+            METRICS_SERVER = await asyncio.start_server(handle_metrics, "127.0.0.1", METRICS_PORT)
+        except OSError as e:
+            print(f"No se pudo abrir el puerto de métricas {METRICS_PORT}: {e}")
+    LOOP_LAG_MONITOR = asyncio.create_task(monitor_loop_lag())
+    FFMPEG_MONITOR = asyncio.create_task(FFMPEG_MANAGER.monitor())
+    if STATE_STORE is not None:
+        # Antes de conectar, para que ningún comando llegue sin el estado ya leído
+        await STATE_STORE.preload(owns_guild)
+        STATE_WRITER = asyncio.create_task(STATE_STORE.run())
+    install_shutdown_handler()
+    # En segundo plano: ni la importación de yt-dlp ni la sincronización retrasan la conexión
+    YTDLP_WARMUP = asyncio.create_task(warm_up_ytdlp())
+    if syncs_commands():
+        COMMAND_SYNC = asyncio.create_task(sync_commands_at_startup())
+
+bot.setup_hook = setup_hook
+
+
+# Bot ready-up code
+@bot.event
+async def on_ready():
+    # on_ready se repite en cada reconexión; lo del arranque solo se hace una vez
+    global PLAYER_SWEEPER
+    if PLAYER_SWEEPER is not None:
+        print(f"{bot.user} se ha vuelto a conectar")
+        return
+    mark_startup("ready")
+    PLAYER_SWEEPER = asyncio.create_task(evict_idle_players())
     print(f"{bot.user} is online!")
 
+
+@bot.event
+async def on_interaction(interaction):
+    if interaction.type == discord.InteractionType.application_command:
+        mark_startup("first_command")
+
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    # Cambios de mute/deafen: no cambia nadie de canal
+    if before.channel == after.channel:
+        return
+
+    guild = member.guild
+    if member.id == bot.user.id:
+        if before.channel is not None:
+            VOICE_PRESENCE.untrack(before.channel)
+        if after.channel is None:
+            # Liberar el estado del servidor cuando el bot sale del canal de voz
+            evict_player(guild.id)
+        else:
+            VOICE_PRESENCE.track(after.channel)
+            update_empty_timer(guild, after.channel)
+        return
+
+    if member.bot:
+        return
+    VOICE_PRESENCE.member_moved(before.channel, after.channel)
+    voice_client = guild.voice_client
+    if voice_client is not None and voice_client.channel in (before.channel, after.channel):
+        update_empty_timer(guild, voice_client.channel)
+
 @bot.event
 async def on_reaction_add(reaction, user):
     # Ignorar las reacciones del propio bot
@@ -126,11 +2480,12 @@ async def on_reaction_add(reaction, user):
     # Obtener el cliente de voz para el servidor
     guild = reaction.message.guild
     voice_client = guild.voice_client
-    guild_id = str(guild.id)
     
     # Verificar que el bot esté conectado a un canal de voz
     if not voice_client:
         return
+
+    player = get_player(guild.id)
     
     # Manejar diferentes reacciones
     emoji = str(reaction.emoji)
@@ -138,88 +2493,103 @@ async def on_reaction_add(reaction, user):
     if emoji == "⏯️":  # Play/Pause
         if voice_client.is_playing():
             voice_client.pause()
-            await reaction.message.channel.send("Reproducción pausada.")
+            DISPATCHER.send(reaction.message.channel, "Reproducción pausada.", key=("controls", guild.id))
         elif voice_client.is_paused():
             voice_client.resume()
-            await reaction.message.channel.send("Reproducción reanudada.")
+            DISPATCHER.send(reaction.message.channel, "Reproducción reanudada.", key=("controls", guild.id))
     
     elif emoji == "⏭️":  # Skip
         if voice_client.is_playing() or voice_client.is_paused():
+            player.skip_requested = True
             voice_client.stop()
-            await reaction.message.channel.send("Saltando a la siguiente canción.")
+            DISPATCHER.send(reaction.message.channel, "Saltando a la siguiente canción.", key=("controls", guild.id))
     
     elif emoji == "🔁":  # Loop
         # Cambiar el modo de bucle cíclicamente: none -> song -> queue -> none
-        current_mode = LOOP_MODES.get(guild_id, "none")
+        current_mode = player.loop_mode
         
         if current_mode == "none":
-            LOOP_MODES[guild_id] = "song"
-            await reaction.message.channel.send("Modo de bucle: Repetir canción actual.")
+            player.loop_mode = "song"
+            DISPATCHER.send(reaction.message.channel, "Modo de bucle: Repetir canción actual.", key=("controls", guild.id))
         elif current_mode == "song":
-            LOOP_MODES[guild_id] = "queue"
-            await reaction.message.channel.send("Modo de bucle: Repetir toda la cola.")
+            player.loop_mode = "queue"
+            DISPATCHER.send(reaction.message.channel, "Modo de bucle: Repetir toda la cola.", key=("controls", guild.id))
         else:
-            LOOP_MODES[guild_id] = "none"
-            await reaction.message.channel.send("Modo de bucle desactivado.")
+            player.loop_mode = "none"
+            DISPATCHER.send(reaction.message.channel, "Modo de bucle desactivado.", key=("controls", guild.id))
     
     elif emoji == "🔀":  # Shuffle
-        if guild_id in SONG_QUEUES and len(SONG_QUEUES[guild_id]) > 1:
+        if len(player.queue) > 1:
             # Mezclar la cola (excepto la canción actual si está reproduciéndose)
-            import random
-            queue_list = list(SONG_QUEUES[guild_id])
-            if voice_client.is_playing() or voice_client.is_paused():
-                current_song = queue_list[0]
-                remaining_songs = queue_list[1:]
-                random.shuffle(remaining_songs)
-                SONG_QUEUES[guild_id] = deque([current_song] + remaining_songs)
-            else:
-                random.shuffle(queue_list)
-                SONG_QUEUES[guild_id] = deque(queue_list)
-            await reaction.message.channel.send("Cola mezclada aleatoriamente.")
+            player.queue.shuffle(keep_first=voice_client.is_playing() or voice_client.is_paused())
+            # Las siguientes canciones han cambiado, precargar las nuevas
+            schedule_prefetch(player)
+            DISPATCHER.send(reaction.message.channel, "Cola mezclada aleatoriamente.", key=("controls", guild.id))
         else:
-            await reaction.message.channel.send("No hay suficientes canciones en la cola para mezclar.")
+            DISPATCHER.send(reaction.message.channel, "No hay suficientes canciones en la cola para mezclar.", key=("controls", guild.id))
     
     elif emoji == "⏹️":  # Stop
         if voice_client.is_connected():
             # Limpiar la cola
-            if guild_id in SONG_QUEUES:
-                SONG_QUEUES[guild_id].clear()
+            player.queue.clear()
+            player.discard_prewarmed()
+            player.now_playing = None
+            player.now_playing_source = None
             
             # Detener la reproducción
             if voice_client.is_playing() or voice_client.is_paused():
+                player.skip_requested = True
                 voice_client.stop()
             
             # Desconectar
             await voice_client.disconnect()
-            await reaction.message.channel.send("Reproducción detenida y bot desconectado.")
+            DISPATCHER.send(reaction.message.channel, "Reproducción detenida y bot desconectado.", key=("controls", guild.id))
     
     elif emoji == "📋":  # Queue
-        if guild_id in SONG_QUEUES and SONG_QUEUES[guild_id]:
-            queue_list = list(SONG_QUEUES[guild_id])
-            
-            # Crear un mensaje con la lista de canciones en cola
-            message = "**Cola de reproducción:**\n"
-            for i, (_, title) in enumerate(queue_list, 1):
-                message += f"{i}. {title}\n"
-                # Limitar el mensaje a 20 canciones para evitar mensajes muy largos
-                if i >= 20 and len(queue_list) > 20:
-                    message += f"... y {len(queue_list) - 20} canciones más."
-                    break
-            
-            await reaction.message.channel.send(message)
+        if player.queue:
+            view = QueueView(player)
+            DISPATCHER.send(reaction.message.channel, embed=view.render(), view=view)
         else:
-            await reaction.message.channel.send("La cola de reproducción está vacía.")
+            DISPATCHER.send(reaction.message.channel, "La cola de reproducción está vacía.", key=("controls", guild.id))
 
 
 @bot.tree.command(name="skip", description="Skips the current playing song")
 async def skip(interaction: discord.Interaction):
     if interaction.guild.voice_client and (interaction.guild.voice_client.is_playing() or interaction.guild.voice_client.is_paused()):
+        get_player(interaction.guild_id).skip_requested = True
         interaction.guild.voice_client.stop()
         await interaction.response.send_message("Skipped the current song.")
     else:
         await interaction.response.send_message("Not playing anything to skip.")
 
 
+@bot.tree.command(name="seek", description="Salta a un momento de la canción actual.")
+@app_commands.describe(position="Momento de la canción: segundos, m:ss o h:mm:ss")
+async def seek(interaction: discord.Interaction, position: str):
+    voice_client = interaction.guild.voice_client
+    player = get_player(interaction.guild_id)
+    track = player.now_playing
+    if voice_client is None or track is None or not (voice_client.is_playing() or voice_client.is_paused()):
+        await interaction.response.send_message("No hay nada reproduciéndose.")
+        return
+    seconds = parse_timestamp(position)
+    if seconds is None:
+        await interaction.response.send_message("Momento no válido. Usa segundos, m:ss o h:mm:ss.")
+        return
+    if track.duration and seconds >= track.duration:
+        await interaction.response.send_message(f"La canción dura {format_duration(track.duration)}.")
+        return
+
+    # La respuesta se prepara antes de cortar la reproducción, por si algo falla
+    reply = f"Saltando a {format_duration(seconds)} en **{track.title}**."
+    # Se vuelve a abrir la misma canción con -ss; la URL de audio ya resuelta se reutiliza
+    track.start_at = seconds
+    requeue_at_front(player, track, requeued=player.loop_mode != "none")
+    player.skip_requested = True
+    voice_client.stop()
+    await interaction.response.send_message(reply)
+
+
 @bot.tree.command(name="pause", description="Pause the currently playing song.")
 async def pause(interaction: discord.Interaction):
     voice_client = interaction.guild.voice_client
@@ -263,12 +2633,15 @@ async def stop(interaction: discord.Interaction):
         return await interaction.response.send_message("I'm not connected to any voice channel.")
 
     # Clear the guild's queue
-    guild_id_str = str(interaction.guild_id)
-    if guild_id_str in SONG_QUEUES:
-        SONG_QUEUES[guild_id_str].clear()
+    player = get_player(interaction.guild_id)
+    player.queue.clear()
+    player.discard_prewarmed()
+    player.now_playing = None
+    player.now_playing_source = None
 
     # If something is playing or paused, stop it
     if voice_client.is_playing() or voice_client.is_paused():
+        player.skip_requested = True
         voice_client.stop()
 
     # (Optional) Disconnect from the channel
@@ -280,7 +2653,9 @@ async def stop(interaction: discord.Interaction):
 @bot.tree.command(name="play", description="Play a song or add it to the queue.")
 @app_commands.describe(song_query="Search query")
 async def play(interaction: discord.Interaction, song_query: str):
+    requested_at = time.monotonic()
     await interaction.response.defer()
+    deadline = interaction_deadline(interaction)
 
     voice_channel = interaction.user.voice.channel
 
@@ -291,158 +2666,1082 @@ async def play(interaction: discord.Interaction, song_query: str):
     voice_client = interaction.guild.voice_client
 
     if voice_client is None:
+        # La comprobación de canal vacío empieza con el evento de voz de la conexión
         voice_client = await voice_channel.connect()
-        # Iniciar la tarea de verificación de usuarios en el canal
-        asyncio.create_task(check_voice_channel(voice_client))
     elif voice_channel != voice_client.channel:
         await voice_client.move_to(voice_channel)
 
-    ydl_options = {
-        "format": "bestaudio[abr<=96]/bestaudio",
-        "noplaylist": False,  # Permitir listas de reproducción
-        "youtube_include_dash_manifest": False,
-        "youtube_include_hls_manifest": False,
-        "extractor_args": {
-            "youtube": {
-                "formats": "missing_pot"
-            }
-        }
-    }
-
     # Detectar si es una URL directa o una búsqueda
     if song_query.startswith(('https://', 'http://', 'www.')):
         query = song_query  # URL directa
-        results = await search_ytdlp_async(query, ydl_options)
-        
-        # Verificar si es una lista de reproducción
-        if 'entries' in results:
-            # Es una lista de reproducción
-            tracks = results['entries']
-            playlist_title = results.get('title', 'Playlist')
-            
-            # Crear la cola si no existe
-            guild_id = str(interaction.guild_id)
-            if SONG_QUEUES.get(guild_id) is None:
-                SONG_QUEUES[guild_id] = deque()
-            
-            # Procesar el primer tema inmediatamente si está disponible
-            first_track_processed = False
-            added_count = 0
-            
-            for i, track in enumerate(tracks):
-                if track:
-                    audio_url = track.get("url")
-                    title = track.get("title", "Untitled")
-                    if audio_url:
-                        # Si es el primer tema y no hay nada reproduciéndose, reproducirlo inmediatamente
-                        if i == 0 and not (voice_client.is_playing() or voice_client.is_paused()):
-                            # En lugar de reproducir directamente, añadir a la cola y usar play_next_song
-                            SONG_QUEUES[guild_id].appendleft((audio_url, title))
-                            await play_next_song(voice_client, guild_id, interaction.channel)
-                            first_track_processed = True
-                            
-                            # Iniciar la tarea de verificación de canal de voz si no está ya en ejecución
-                            if not hasattr(voice_client, 'check_voice_channel_task') or voice_client.check_voice_channel_task.done():
-                                voice_client.check_voice_channel_task = asyncio.create_task(check_voice_channel(voice_client))
-                        else:
-                            # Añadir el resto de temas a la cola
-                            SONG_QUEUES[guild_id].append((audio_url, title))
-                        
-                        added_count += 1
-            
-            # Informar al usuario sobre la lista de reproducción
-            await interaction.followup.send(f"Added {added_count} songs from playlist **{playlist_title}** to the queue.")
-            
-            # Si no se procesó el primer tema (porque ya había algo reproduciéndose), asegurarse de que haya algo en reproducción
-            if not first_track_processed and not (voice_client.is_playing() or voice_client.is_paused()) and SONG_QUEUES[guild_id]:
-                await play_next_song(voice_client, guild_id, interaction.channel)
-            
+        try:
+            if is_playlist_url(query):
+                # Lista de reproducción: se va añadiendo a la cola a medida que se extrae
+                await enqueue_playlist(
+                    interaction, voice_client, stream_playlist(query, FLAT_YDL_OPTIONS, deadline), requested_at
+                )
+                return
+            # Extracción "flat": si resulta ser una lista, sus canciones se resuelven al reproducirlas
+            results = await search_ytdlp_async(query, FLAT_YDL_OPTIONS, deadline, site="play")
+            if 'entries' in results:
+                await enqueue_playlist(interaction, voice_client, results_batches(results), requested_at)
+                return
+        except ExtractionCancelled:
+            # La interacción ya caducó, no hay a quién responder
+            print(f"Extracción cancelada para {song_query}: la interacción caducó")
             return
-        else:
-            # Es un solo video
-            tracks = [results] if results else []
+
+        # Es un solo video
+        tracks = [results] if results else []
     else:
         query = "ytsearch1: " + song_query  # Búsqueda de texto
-        results = await search_ytdlp_async(query, ydl_options)
+        try:
+            results = await search_ytdlp_async(query, YDL_OPTIONS, deadline, site="play")
+        except ExtractionCancelled:
+            # La interacción ya caducó, no hay a quién responder
+            print(f"Extracción cancelada para {song_query}: la interacción caducó")
+            return
         tracks = results.get("entries", [])
 
-    if tracks is None:
+    if not tracks:
         await interaction.followup.send("No results found.")
         return
 
-    first_track = tracks[0]
-    audio_url = first_track["url"]
-    title = first_track.get("title", "Untitled")
-
-    guild_id = str(interaction.guild_id)
-    if SONG_QUEUES.get(guild_id) is None:
-        SONG_QUEUES[guild_id] = deque()
+    track = Track.from_info(tracks[0])
+    track.requested_at = requested_at
+    title = track.title
 
-    SONG_QUEUES[guild_id].append((audio_url, title))
+    guild_id = interaction.guild_id
+    player = get_player(guild_id)
+    player.queue.append(track)
 
     if voice_client.is_playing() or voice_client.is_paused():
         await interaction.followup.send(f"Added to queue: **{title}**")
+    elif player.queue[0] is not track:
+        # Quedaba una cola guardada de antes de reiniciar: continúa ella primero
+        await interaction.followup.send(
+            f"Resuming the saved queue with **{player.queue[0].title}**. Added to queue: **{title}**"
+        )
+        await play_next_song(voice_client, guild_id, interaction.channel)
     else:
         await interaction.followup.send(f"Now playing: **{title}**")
         await play_next_song(voice_client, guild_id, interaction.channel)
 
 
+@bot.tree.command(name="playmany", description="Añade varias canciones a la cola de una vez.")
+@app_commands.describe(
+    songs="Búsquedas o URLs separadas por ;",
+    file="Archivo de texto con una búsqueda o URL por línea",
+)
+async def playmany(interaction: discord.Interaction, songs: str = None, file: discord.Attachment = None):
+    requested_at = time.monotonic()
+    await interaction.response.defer()
+
+    text = songs or ""
+    if file is not None:
+        if file.size > BULK_MAX_BYTES:
+            await interaction.followup.send(f"The file is too large (max {BULK_MAX_BYTES // 1024} KB).")
+            return
+        text += "\n" + (await file.read()).decode("utf-8", errors="replace")
+    queries = parse_bulk_queries(text)
+    if not queries:
+        await interaction.followup.send("Give a list of songs separated by ; or attach a text file.")
+        return
+    if len(queries) > BULK_MAX_QUERIES:
+        await interaction.followup.send(f"Too many songs: {len(queries)} (max {BULK_MAX_QUERIES}).")
+        return
+
+    voice_state = interaction.user.voice
+    if voice_state is None or voice_state.channel is None:
+        await interaction.followup.send("You must be in a voice channel.")
+        return
+    voice_channel = voice_state.channel
+
+    voice_client = interaction.guild.voice_client
+    if voice_client is None:
+        voice_client = await voice_channel.connect()
+    elif voice_channel != voice_client.channel:
+        await voice_client.move_to(voice_channel)
+
+    await enqueue_many(interaction, voice_client, queries, requested_at)
+
+
+# Bitrate de salida hacia Discord, en kbps
+OPUS_BITRATE = 96
+
+def find_ffmpeg():
+    """Ruta de ffmpeg: FFMPEG_PATH, la copia de bin/ffmpeg del repositorio o la del PATH."""
+    configured = os.getenv("FFMPEG_PATH")
+    if configured:
+        return configured
+    name = "ffmpeg.exe" if os.name == "nt" else "ffmpeg"
+    bundled = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin", "ffmpeg", name)
+    if os.path.isfile(bundled):
+        return bundled
+    return shutil.which("ffmpeg") or "ffmpeg"
+
+
+FFMPEG_EXECUTABLE = find_ffmpeg()
+# Procesos de ffmpeg simultáneos como máximo en este proceso (launcher.py reparte el de la máquina)
+FFMPEG_MAX_PROCESSES = int(os.getenv("FFMPEG_MAX_PROCESSES", "64"))
+# Segundos que se espera a que quede un hueco antes de dar la canción por fallida
+FFMPEG_SPAWN_TIMEOUT = float(os.getenv("FFMPEG_SPAWN_TIMEOUT", "15"))
+# Cada cuántos segundos se mide la CPU y la memoria de los procesos
+FFMPEG_SAMPLE_INTERVAL = 10.0
+
+# psutil es opcional; sin él se lee /proc (solo Linux)
+try:
+    import psutil
+    SAMPLE_ERRORS = (OSError, ValueError, IndexError, psutil.Error)
+except ImportError:
+    psutil = None
+    SAMPLE_ERRORS = (OSError, ValueError, IndexError)
+
+
+class FFmpegUnavailable(Exception):
+    """No se ha podido abrir ffmpeg porque se ha alcanzado el máximo de procesos."""
+
+
+class FFmpegManager:
+    """Lleva la cuenta de los procesos de ffmpeg, limita cuántos hay a la vez y mide sus recursos.
+
+    Las fuentes de discord.py y los procesos de la caché de audio se registran
+    al crearse; se consideran vivos mientras el proceso no haya terminado.
+    """
+
+    def __init__(self, max_processes):
+        self.max_processes = max_processes
+        self._sources = weakref.WeakSet()
+        self._processes = weakref.WeakSet()
+        # pid -> (tiempo de CPU acumulado, instante de la medida), para calcular el uso entre medidas
+        self._cpu_times = {}
+        self.spawned = 0
+        self.rejected = 0
+        self.waits = 0
+        self.waited_seconds = 0.0
+        self.cpu_percent = 0.0
+        self.rss_bytes = 0
+
+    def _pids(self):
+        pids = []
+        for source in list(self._sources):
+            process = getattr(source, "_process", None)
+            if process is not None and hasattr(process, "poll") and process.poll() is None:
+                pids.append(process.pid)
+        for process in list(self._processes):
+            if process.returncode is None:
+                pids.append(process.pid)
+        return pids
+
+    def count(self):
+        return len(self._pids())
+
+    def register(self, source):
+        """Anota una fuente de discord.py (FFmpegOpusAudio) recién creada."""
+        self._sources.add(source)
+        self.spawned += 1
+        return source
+
+    def register_process(self, process):
+        """Anota un proceso lanzado con asyncio.create_subprocess_exec."""
+        self._processes.add(process)
+        self.spawned += 1
+        return process
+
+    def available(self):
+        return self.count() < self.max_processes
+
+    async def acquire(self, timeout=FFMPEG_SPAWN_TIMEOUT):
+        """Espera a que haya hueco para un proceso más.
+
+        Hay que crear el proceso justo después, sin otro await entremedias, para
+        que nadie ocupe el hueco antes.
+        """
+        if self.available():
+            return
+        self.waits += 1
+        started = time.monotonic()
+        try:
+            while not self.available():
+                if time.monotonic() - started >= timeout:
+                    self.rejected += 1
+                    raise FFmpegUnavailable(f"{self.max_processes} procesos de ffmpeg en marcha")
+                await asyncio.sleep(0.25)
+        finally:
+            self.waited_seconds += time.monotonic() - started
+
+    def _sample(self, pids):
+        """Mide CPU (%) y memoria residente de los procesos, con psutil o con /proc."""
+        now = time.monotonic()
+        cpu_total = 0.0
+        rss_total = 0
+        cpu_times = {}
+        for pid in pids:
+            try:
+                if psutil is not None:
+                    process = psutil.Process(pid)
+                    times = process.cpu_times()
+                    cpu = times.user + times.system
+                    rss = process.memory_info().rss
+                else:
+                    with open(f"/proc/{pid}/stat") as f:
+                        fields = f.read().rsplit(")", 1)[1].split()
+                    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+                    with open(f"/proc/{pid}/statm") as f:
+                        rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            except SAMPLE_ERRORS:
+                # Proceso ya terminado, o sistema sin /proc ni psutil
+                continue
+            previous = self._cpu_times.get(pid)
+            if previous is not None and now > previous[1]:
+                cpu_total += (cpu - previous[0]) / (now - previous[1]) * 100
+            cpu_times[pid] = (cpu, now)
+            rss_total += rss
+        self._cpu_times = cpu_times
+        self.cpu_percent = round(cpu_total, 1)
+        self.rss_bytes = rss_total
+
+    async def monitor(self):
+        """Mide periódicamente los recursos de los procesos vivos."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(FFMPEG_SAMPLE_INTERVAL)
+            try:
+                await loop.run_in_executor(None, self._sample, self._pids())
+            except Exception as e:
+                print(f"Error al medir los procesos de ffmpeg: {e}")
+
+    def stats(self):
+        return {
+            "processes": self.count(),
+            "max_processes": self.max_processes,
+            "spawned": self.spawned,
+            "waits": self.waits,
+            "waited_seconds": round(self.waited_seconds, 3),
+            "rejected": self.rejected,
+            "cpu_percent": self.cpu_percent,
+            "rss_bytes": self.rss_bytes,
+        }
+
+
+FFMPEG_MANAGER = FFmpegManager(FFMPEG_MAX_PROCESSES)
+
+# Caché local de audio (Ogg/Opus) para las canciones más escuchadas
+AUDIO_CACHE_ENABLED = os.getenv("AUDIO_CACHE_ENABLED", "0") == "1"
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", os.path.join("cache", "audio"))
+# Reproducciones necesarias para guardar una canción en disco
+AUDIO_CACHE_THRESHOLD = int(os.getenv("AUDIO_CACHE_THRESHOLD", "3"))
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+
+class AudioCache:
+    """Guarda en disco, ya codificadas en Ogg/Opus, las canciones que más se repiten.
+
+    Lleva la cuenta de reproducciones por vídeo; al superar el umbral descarga la
+    canción una sola vez y las siguientes veces se sirve el fichero sin recodificar.
+    El tamaño total está limitado y se expulsan primero las menos usadas.
+    """
+
+    def __init__(self, directory, threshold, max_bytes):
+        self.directory = directory
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self._db = None
+        self._lock = threading.Lock()
+        self._downloading = set()
+        self._verified = set()
+        self._downloads = None
+        # Descargas en curso: asyncio solo guarda referencias débiles a las tareas
+        self._tasks = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(self.directory, "index.sqlite3"), check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS audio (
+                    video_id TEXT PRIMARY KEY,
+                    plays INTEGER NOT NULL DEFAULT 0,
+                    path TEXT,
+                    size INTEGER,
+                    sha256 TEXT,
+                    last_access REAL
+                )
+            """)
+        return self._db
+
+    @staticmethod
+    def _sha256(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _forget(db, video_id):
+        db.execute("UPDATE audio SET path = NULL, size = NULL, sha256 = NULL WHERE video_id = ?", (video_id,))
+
+    @staticmethod
+    def _remove_files(paths):
+        """Borra ficheros ya dados de baja en el índice (después del commit).
+
+        En Windows no se puede borrar un fichero que ffmpeg aún está leyendo;
+        ese fallo no debe deshacer los cambios del índice.
+        """
+        for path in paths:
+            try:
+                if path and os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                print(f"No se pudo borrar {path} de la caché de audio: {e}")
+
+    def _lookup(self, video_id):
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT path, size, sha256 FROM audio WHERE video_id = ?", (video_id,)).fetchone()
+            if row is None or row[0] is None:
+                self.misses += 1
+                return None
+            path, size, sha256 = row
+            # Comprobación rápida siempre; el hash completo una vez por fichero y ejecución
+            valid = os.path.exists(path) and os.path.getsize(path) == size
+            if valid:
+                with open(path, "rb") as f:
+                    valid = f.read(4) == b"OggS"
+            if valid and video_id not in self._verified:
+                valid = self._sha256(path) == sha256
+            if not valid:
+                print(f"Fichero de audio en caché corrupto, se descarta: {path}")
+                with db:
+                    self._forget(db, video_id)
+                self._remove_files([path])
+                self.misses += 1
+                return None
+            with db:
+                db.execute("UPDATE audio SET last_access = ? WHERE video_id = ?", (time.time(), video_id))
+            self._verified.add(video_id)
+            self.hits += 1
+            return path
+
+    def _count_play(self, video_id):
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute(
+                    "INSERT INTO audio (video_id, plays) VALUES (?, 1) "
+                    "ON CONFLICT(video_id) DO UPDATE SET plays = plays + 1",
+                    (video_id,),
+                )
+            return db.execute("SELECT plays, path FROM audio WHERE video_id = ?", (video_id,)).fetchone()
+
+    def _store(self, video_id, tmp_path):
+        final_path = os.path.join(self.directory, f"{video_id}.opus")
+        size = os.path.getsize(tmp_path)
+        sha256 = self._sha256(tmp_path)
+        os.replace(tmp_path, final_path)
+        evicted = []
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute(
+                    "UPDATE audio SET path = ?, size = ?, sha256 = ?, last_access = ? WHERE video_id = ?",
+                    (final_path, size, sha256, time.time(), video_id),
+                )
+                self._verified.add(video_id)
+                # Expulsar las menos usadas hasta volver a estar por debajo del límite
+                total = db.execute("SELECT COALESCE(SUM(size), 0) FROM audio WHERE path IS NOT NULL").fetchone()[0]
+                rows = db.execute(
+                    "SELECT video_id, path, size FROM audio WHERE path IS NOT NULL ORDER BY last_access"
+                ).fetchall()
+                for old_id, old_path, old_size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    self._forget(db, old_id)
+                    evicted.append(old_path)
+                    self._verified.discard(old_id)
+                    total -= old_size
+                    self.evictions += 1
+            self._remove_files(evicted)
+
+    async def lookup(self, video_id):
+        """Ruta del fichero en caché para el vídeo, o None si no está (o está dañado)."""
+        if not video_id:
+            return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._lookup, video_id)
+
+    async def record_play(self, track, audio_url):
+        """Cuenta una reproducción y descarga la canción si ya es popular."""
+        if not track.video_id or track.video_id in self._downloading:
+            return
+        loop = asyncio.get_running_loop()
+        plays, path = await loop.run_in_executor(None, self._count_play, track.video_id)
+        if path is None and plays >= self.threshold:
+            self._downloading.add(track.video_id)
+            task = asyncio.create_task(self._download(track.video_id, audio_url))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _download(self, video_id, audio_url):
+        # Una sola descarga a la vez para no competir con la reproducción
+        if self._downloads is None:
+            self._downloads = asyncio.Semaphore(1)
+        tmp_path = os.path.join(self.directory, f"{video_id}.part")
+        try:
+            async with self._downloads:
+                # La caché es opcional: no esperar por un hueco que necesita la reproducción
+                if not FFMPEG_MANAGER.available():
+                    return
+                process = await asyncio.create_subprocess_exec(
+                    FFMPEG_EXECUTABLE, "-nostdin", "-loglevel", "error", "-y",
+                    "-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5",
+                    "-i", audio_url, "-vn", "-c:a", "libopus", "-b:a", f"{OPUS_BITRATE}k",
+                    "-f", "ogg", tmp_path,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+                )
+                FFMPEG_MANAGER.register_process(process)
+                _, stderr = await process.communicate()
+            if process.returncode != 0:
+                print(f"Error al guardar {video_id} en la caché de audio: {stderr.decode(errors='ignore').strip()}")
+                return
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._store, video_id, tmp_path)
+        except Exception as e:
+            print(f"Error al guardar {video_id} en la caché de audio: {e}")
+        finally:
+            self._downloading.discard(video_id)
+            self._remove_files([tmp_path])
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "downloading": len(self._downloading)}
+
+
+AUDIO_CACHE = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_THRESHOLD, AUDIO_CACHE_MAX_BYTES) if AUDIO_CACHE_ENABLED else None
+
+
+# Cuántas canciones de la cola se mantienen con la URL de audio ya resuelta
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", "2"))
+# Abrir ffmpeg para la siguiente canción unos segundos antes de que acabe la actual
+PREWARM_FFMPEG = os.getenv("PREWARM_FFMPEG", "0") == "1"
+PREWARM_LEAD = float(os.getenv("PREWARM_LEAD", "5"))
+
+
+class QualityProfile:
+    """Formato que se pide a YouTube y parámetros del codificador Opus para un stream."""
+
+    __slots__ = ("name", "max_abr", "bitrate", "complexity", "max_pressure", "ydl_options")
+
+    def __init__(self, name, max_abr, bitrate, complexity, max_pressure):
+        self.name = name
+        # Bitrate máximo del audio de origen que se pide a YouTube
+        self.max_abr = max_abr
+        # Bitrate (kbps) y complejidad (0-10) de libopus al recodificar
+        self.bitrate = bitrate
+        self.complexity = complexity
+        # Carga máxima de la máquina con la que se usa este perfil
+        self.max_pressure = max_pressure
+        self.ydl_options = {**STREAM_YDL_OPTIONS, "format": f"bestaudio[abr<={max_abr}]/bestaudio"}
+
+    def with_bitrate(self, bitrate):
+        """Copia del perfil con otro bitrate de salida (p. ej. el del canal de voz)."""
+        profile = QualityProfile(self.name, self.max_abr, bitrate, self.complexity, self.max_pressure)
+        profile.ydl_options = self.ydl_options
+        return profile
+
+
+# De mayor a menor calidad. Los perfiles bajos piden formatos más ligeros, que a menudo se
+# pueden enviar sin recodificar, y usan menos CPU cuando sí hay que hacerlo.
+# Discord solo acepta tramas de 20 ms, así que la duración de trama no se cambia.
+QUALITY_PROFILES = [
+    QualityProfile("high", 160, 128, 10, 0.5),
+    QualityProfile("normal", OPUS_BITRATE, OPUS_BITRATE, 10, 0.75),
+    QualityProfile("reduced", 80, 64, 5, 0.9),
+    QualityProfile("low", 56, 48, 0, float("inf")),
+]
+# "auto" elige el perfil según la carga; o el nombre de un perfil para fijarlo
+QUALITY_MODE = os.getenv("QUALITY_PROFILE", "auto")
+
+
+class QualityPolicy:
+    """Elige el perfil de calidad de cada stream.
+
+    La presión es el máximo entre la carga de CPU de la máquina, la fracción
+    de procesos de ffmpeg ocupados y el retraso reciente del event loop (que
+    es lo primero que sube antes de que se corten paquetes de audio). El
+    bitrate nunca supera el del canal de voz.
+    """
+
+    def __init__(self, profiles, mode="auto"):
+        self.profiles = profiles
+        self.mode = mode
+        self.chosen = {profile.name: 0 for profile in profiles}
+        self.pressure = 0.0
+        if psutil is not None:
+            # La primera llamada solo fija el punto de partida
+            psutil.cpu_percent(None)
+
+    @staticmethod
+    def host_load():
+        """Uso de CPU de la máquina, entre 0 y 1 (puede pasar de 1 con load average)."""
+        if psutil is not None:
+            return psutil.cpu_percent(None) / 100
+        cpus = os.cpu_count() or 1
+        if hasattr(os, "getloadavg"):
+            return os.getloadavg()[0] / cpus
+        # Sin psutil ni load average (Windows): solo la CPU que usan los ffmpeg
+        return FFMPEG_MANAGER.cpu_percent / (100 * cpus)
+
+    def current_pressure(self):
+        recent_lag = max(RECENT_LOOP_LAG, default=0.0)
+        return max(
+            self.host_load(),
+            FFMPEG_MANAGER.count() / max(1, FFMPEG_MANAGER.max_processes),
+            recent_lag / LOOP_LAG_WARNING,
+        )
+
+    def choose(self, channel_bitrate=None, count=True):
+        """Perfil para un stream nuevo. channel_bitrate es el del canal de voz, en bps.
+
+        El perfil depende solo de la presión; el canal de voz limita únicamente el
+        bitrate de salida. count=False no lo cuenta en las estadísticas (precargas).
+        """
+        fixed = [profile for profile in self.profiles if profile.name == self.mode]
+        if fixed:
+            profile = fixed[0]
+        else:
+            self.pressure = self.current_pressure()
+            profile = next(profile for profile in self.profiles if self.pressure <= profile.max_pressure)
+        if count:
+            self.chosen[profile.name] += 1
+        channel_kbps = channel_bitrate // 1000 if channel_bitrate else None
+        if channel_kbps and channel_kbps < profile.bitrate:
+            profile = profile.with_bitrate(channel_kbps)
+        return profile
+
+    def stats(self):
+        return {"mode": self.mode, "pressure": round(self.pressure, 3), "chosen": dict(self.chosen)}
+
+
+QUALITY_POLICY = QualityPolicy(QUALITY_PROFILES, QUALITY_MODE)
+
+
+def voice_channel_bitrate(voice_client):
+    channel = getattr(voice_client, "channel", None)
+    return getattr(channel, "bitrate", None)
+
+
+def can_passthrough(track, profile):
+    """Un stream Opus que no supera el bitrate de salida del perfil se puede enviar sin recodificar.
+
+    El bitrate de salida ya está limitado por el del canal de voz.
+    """
+    return track.acodec == "opus" and track.abr is not None and track.abr <= profile.bitrate
+
+
+# Duración de cada paquete Opus que se envía a Discord
+FRAME_SECONDS = 0.02
+
+
+class InstrumentedSource(discord.AudioSource):
+    """Envuelve una fuente de audio para saber cuándo sale el primer paquete y por dónde va.
+
+    La posición se calcula contando paquetes (20 ms cada uno), así que no
+    avanza durante las pausas ni cuando el envío se retrasa.
+    """
+
+    def __init__(self, source, on_first_packet, offset=0.0):
+        self.original = source
+        self._on_first_packet = on_first_packet
+        self.started = False
+        # Segundo del tema en el que empezó esta fuente (-ss)
+        self.offset = offset
+        self.frames = 0
+
+    @property
+    def elapsed(self):
+        return self.offset + self.frames * FRAME_SECONDS
+
+    def read(self):
+        data = self.original.read()
+        if data:
+            self.frames += 1
+            if not self.started:
+                # read() se llama desde el hilo de audio de discord.py
+                self.started = True
+                self._on_first_packet(time.monotonic())
+        return data
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+
+def seek_option(start_at):
+    """Opción de ffmpeg para empezar en un segundo dado; delante de -i busca en la entrada sin decodificar."""
+    return f"-ss {start_at:.2f} " if start_at > 0 else ""
+
+
+def create_audio_source(audio_url, track, profile, start_at=0.0):
+    ffmpeg_options = {
+        "before_options": seek_option(start_at) + "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
+    }
+    if can_passthrough(track, profile):
+        # ffmpeg solo reempaqueta (WebM -> Ogg) con "-c:a copy"
+        return FFMPEG_MANAGER.register(discord.FFmpegOpusAudio(
+            audio_url, codec="opus", options="-vn", **ffmpeg_options, executable=FFMPEG_EXECUTABLE
+        ))
+    return FFMPEG_MANAGER.register(discord.FFmpegOpusAudio(
+        audio_url,
+        options=(
+            f"-vn -c:a libopus -b:a {profile.bitrate}k -compression_level {profile.complexity} -frame_duration 20"
+        ),
+        **ffmpeg_options, executable=FFMPEG_EXECUTABLE,
+    ))
+
+
+async def open_track_source(track, channel_bitrate=None, start_at=0.0):
+    """Abre la fuente de audio de una canción: desde la caché local o desde el stream remoto.
+
+    start_at es el segundo desde el que empieza a sonar.
+    """
+    if AUDIO_CACHE is not None:
+        path = await AUDIO_CACHE.lookup(track.video_id)
+        if path is not None:
+            # El fichero ya es Ogg/Opus: se pasa tal cual, sin recodificar
+            # (discord.py solo usa "-c:a copy" cuando el códec indicado es "opus")
+            await FFMPEG_MANAGER.acquire()
+            return FFMPEG_MANAGER.register(discord.FFmpegOpusAudio(
+                path, codec="opus", before_options=seek_option(start_at).strip() or None, options="-vn",
+                executable=FFMPEG_EXECUTABLE,
+            ))
+    profile = QUALITY_POLICY.choose(channel_bitrate)
+    audio_url = await resolve_stream(track, profile)
+    if AUDIO_CACHE is not None:
+        await AUDIO_CACHE.record_play(track, audio_url)
+    await FFMPEG_MANAGER.acquire()
+    source = create_audio_source(audio_url, track, profile, start_at)
+    passthrough = can_passthrough(track, profile)
+    METRICS.inc("musicbot_stream_profile_total", profile=profile.name, passthrough=passthrough)
+    log_event(
+        "stream_profile", title=track.title, profile=profile.name, bitrate=profile.bitrate,
+        complexity=profile.complexity, source_abr=track.abr, passthrough=passthrough,
+        pressure=round(QUALITY_POLICY.pressure, 3),
+    )
+    return source
+
+
+def take_prewarmed(player, track):
+    """Devuelve la fuente ya abierta si corresponde a esta canción."""
+    entry = player.prewarmed
+    if entry is None:
+        return None
+    player.prewarmed = None
+    prewarmed_track, source = entry
+    # Se abrió desde el principio: no sirve si hay que empezar más adelante
+    if prewarmed_track is track and not track.start_at:
+        return source
+    # La cola cambió (shuffle, clear, skip...) y ya no sirve
+    source.cleanup()
+    return None
+
+
+async def prefetch_upcoming(player):
+    """Resuelve la URL de audio de las próximas canciones de la cola."""
+    # El modo bucle ya ha reordenado la cola, así que las primeras son las siguientes en sonar
+    profile = None
+    for track in list(itertools.islice(player.queue, PREFETCH_COUNT)):
+        if track.stream_valid():
+            continue
+        if profile is None:
+            guild = bot.get_guild(player.guild_id)
+            profile = QUALITY_POLICY.choose(voice_channel_bitrate(guild.voice_client if guild else None), count=False)
+        try:
+            await resolve_stream(track, profile)
+        except Exception as e:
+            print(f"Error al precargar {track.title}: {e}")
+
+
+def schedule_prefetch(player):
+    task = player.prefetch_task
+    if task is not None and not task.done():
+        task.cancel()
+    player.prefetch_task = asyncio.create_task(prefetch_upcoming(player))
+
+
+async def prewarm_next(voice_client, player, current):
+    """Abre ffmpeg para la siguiente canción poco antes de que termine la actual."""
+    try:
+        # Se mide por la posición real (no avanza en pausa), no por el tiempo transcurrido
+        while True:
+            source = player.now_playing_source
+            if player.now_playing is not current or source is None:
+                return
+            remaining = current.duration - source.elapsed
+            if remaining <= PREWARM_LEAD:
+                break
+            await asyncio.sleep(max(1.0, remaining - PREWARM_LEAD))
+        # Mientras esté en pausa no tiene sentido abrirla todavía
+        while voice_client.is_paused():
+            await asyncio.sleep(1)
+        if not voice_client.is_playing() or not player.queue:
+            return
+        next_track = player.queue[0]
+        # Abrir por adelantado es opcional: no ocupar un hueco si ya no quedan
+        if not FFMPEG_MANAGER.available():
+            return
+        source = await open_track_source(next_track, voice_channel_bitrate(voice_client))
+        player.discard_prewarmed()
+        player.prewarmed = (next_track, source)
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        print(f"Error al preparar la siguiente canción: {e}")
+
+
+def schedule_prewarm(voice_client, player, current):
+    task = player.prewarm_task
+    if task is not None and not task.done():
+        task.cancel()
+    player.prewarm_task = None
+    if PREWARM_FFMPEG and current.duration:
+        player.prewarm_task = asyncio.create_task(prewarm_next(voice_client, player, current))
+
+
+async def results_batches(results):
+    """Adapta una lista ya extraída al formato de lotes de stream_playlist."""
+    yield results.get("title"), results.get("entries") or []
+
+
+async def enqueue_playlist(interaction, voice_client, batches, requested_at=None):
+    """Añade a la cola los lotes de una lista a medida que llegan."""
+    guild_id = interaction.guild_id
+    player = get_player(guild_id)
+
+    progress = await interaction.followup.send("Cargando lista de reproducción...", wait=True)
+    playlist_title = "Playlist"
+    added_count = 0
+    first_track = None
+    started = None
+    last_update = time.monotonic()
+
+    async for title, batch in batches:
+        playlist_title = title or playlist_title
+        tracks = [Track.from_info(info) for info in batch if info]
+        tracks = [track for track in tracks if track.webpage_url]
+        if not tracks:
+            continue
+
+        player.queue.extend(tracks)
+        if first_track is None:
+            first_track = tracks[0]
+            # Si no hay nada reproduciéndose, empieza en cuanto llega el primer tema
+            # (o la cola guardada de antes de reiniciar, si la había)
+            if not (voice_client.is_playing() or voice_client.is_paused()):
+                started = player.queue[0]
+                started.requested_at = requested_at
+                await play_next_song(voice_client, guild_id, interaction.channel)
+        added_count += len(tracks)
+
+        # Informar del progreso sin editar el mensaje en cada lote
+        if time.monotonic() - last_update >= PLAYLIST_PROGRESS_INTERVAL:
+            last_update = time.monotonic()
+            try:
+                await progress.edit(content=f"Añadiendo **{playlist_title}**: {added_count} canciones en cola...")
+            except discord.HTTPException as e:
+                print(f"Error al actualizar el progreso de la lista: {e}")
+
+    # Informar al usuario sobre la lista de reproducción
+    summary = f"Added {added_count} songs from playlist **{playlist_title}** to the queue."
+    if started is not None and started is not first_track:
+        summary += f" The saved queue resumes first with **{started.title}**."
+    await progress.edit(content=summary)
+
+    # Asegurarse de que haya algo en reproducción
+    if not (voice_client.is_playing() or voice_client.is_paused()) and player.queue:
+        await play_next_song(voice_client, guild_id, interaction.channel)
+
+
+# Canciones como máximo en un /playmany y tamaño máximo del archivo adjunto
+BULK_MAX_QUERIES = int(os.getenv("BULK_MAX_QUERIES", "100"))
+BULK_MAX_BYTES = 64 * 1024
+# Búsquedas de un /playmany que se resuelven a la vez
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "4"))
+# Numeración al principio de una línea ("1. ", "2) ", "- ")
+BULK_LINE_PREFIX = re.compile(r"^\s*(?:\d+[.)]|[-*•])\s+")
+
+
+def parse_bulk_queries(text):
+    """Separa una lista pegada o un archivo en búsquedas: una por línea o separadas por ";".
+
+    Se ignoran las líneas vacías, los comentarios (#) y la numeración inicial.
+    """
+    queries = []
+    for line in text.splitlines():
+        if line.lstrip().startswith("#"):
+            continue
+        for part in line.split(";"):
+            query = BULK_LINE_PREFIX.sub("", part).strip()
+            if query:
+                queries.append(query)
+    return queries
+
+
+async def resolve_bulk_query(query, deadline):
+    """Canciones de una búsqueda de /playmany; una URL de lista devuelve todas sus canciones."""
+    if query.startswith(('https://', 'http://', 'www.')):
+        results = await search_ytdlp_async(query, FLAT_YDL_OPTIONS, deadline, site="playmany")
+        entries = results.get("entries") if "entries" in results else [results]
+    else:
+        results = await search_ytdlp_async("ytsearch1: " + query, YDL_OPTIONS, deadline, site="playmany")
+        entries = results.get("entries", [])[:1]
+    tracks = [Track.from_info(info) for info in entries or [] if info]
+    return [track for track in tracks if track.webpage_url]
+
+
+async def enqueue_many(interaction, voice_client, queries, requested_at=None):
+    """Resuelve varias búsquedas a la vez y las añade a la cola en el orden en que se enviaron.
+
+    Cada canción entra en la cola en cuanto están resueltas todas las anteriores,
+    así que la primera empieza a sonar sin esperar al resto. Al final se
+    responde con un solo resumen.
+    """
+    guild_id = interaction.guild_id
+    player = get_player(guild_id)
+    deadline = interaction_deadline(interaction)
+    limit = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def resolve(query):
+        async with limit:
+            return await resolve_bulk_query(query, deadline)
+
+    tasks = [asyncio.create_task(resolve(query)) for query in queries]
+    added = []
+    failed = []
+    started = None
+    try:
+        # Esperar en orden: las siguientes se siguen resolviendo mientras tanto
+        for query, task in zip(queries, tasks):
+            try:
+                tracks = await task
+            except ExtractionCancelled:
+                # La interacción caducó, no hay a quién responder
+                print(f"/playmany cancelado: la interacción caducó tras {len(added)} canciones")
+                return
+            except Exception as e:
+                print(f"Error al resolver {query} en /playmany: {e}")
+                tracks = []
+            if not tracks:
+                failed.append(query)
+                continue
+            player.queue.extend(tracks)
+            if not added and not (voice_client.is_playing() or voice_client.is_paused()):
+                # Con una cola guardada de antes de reiniciar, empieza por ella
+                started = player.queue[0]
+                started.requested_at = requested_at
+                await play_next_song(voice_client, guild_id, interaction.channel)
+            added.extend(tracks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if not added:
+        await interaction.followup.send("No results found.")
+        return
+    if started is None:
+        summary = f"Added {len(added)} songs to the queue."
+    elif started is added[0]:
+        summary = f"Added {len(added)} songs to the queue, starting with **{added[0].title}**."
+    else:
+        summary = f"Added {len(added)} songs to the queue after the saved queue, which resumes with **{started.title}**."
+    if failed:
+        shown = ", ".join(failed[:10]) + (" ..." if len(failed) > 10 else "")
+        summary += f"\nNo results for {len(failed)}: {shown}"
+    await interaction.followup.send(summary[:2000])
+
+
 async def play_next_song(voice_client, guild_id, channel):
-    if SONG_QUEUES[guild_id]:
-        audio_url, title = SONG_QUEUES[guild_id].popleft()
+    # El bot pudo desconectarse mientras terminaba la canción anterior
+    if not voice_client.is_connected():
+        return
+
+    player = get_player(guild_id)
+    if player.queue:
+        track = player.queue.popleft()
+        title = track.title
+
+        # Usar la fuente abierta por adelantado o resolver la URL de audio justo antes de reproducir
+        source = take_prewarmed(player, track)
+        offset = track.start_at
+        if source is None:
+            try:
+                source = await open_track_source(track, voice_channel_bitrate(voice_client), offset)
+            except Exception as e:
+                print(f"Error al resolver {title}: {e}")
+                METRICS.inc("musicbot_playback_errors_total", stage="open")
+                return await handle_stream_failure(voice_client, guild_id, channel, track, requeued=False)
         
         # Verificar el modo de bucle
-        if guild_id in LOOP_MODES:
-            # Si está en modo bucle de canción, volver a añadir la misma canción al principio
-            if LOOP_MODES[guild_id] == "song":
-                SONG_QUEUES[guild_id].appendleft((audio_url, title))
-            # Si está en modo bucle de cola, añadir la canción al final
-            elif LOOP_MODES[guild_id] == "queue":
-                SONG_QUEUES[guild_id].append((audio_url, title))
-
-        ffmpeg_options = {
-            "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-            "options": "-vn -c:a libopus -b:a 96k",
-            # Remove executable if FFmpeg is in PATH
-        }
-
-        source = discord.FFmpegOpusAudio(audio_url, **ffmpeg_options, executable="bin\\ffmpeg\\ffmpeg.exe")
+        # Si está en modo bucle de canción, volver a añadir la misma canción al principio
+        if player.loop_mode == "song":
+            player.queue.appendleft(track)
+        # Si está en modo bucle de cola, añadir la canción al final
+        elif player.loop_mode == "queue":
+            player.queue.append(track)
+
+        requested_at, track.requested_at = track.requested_at, None
+        # La próxima vez (bucle) vuelve a empezar desde el principio
+        track.start_at = 0.0
+
+        def first_packet(now):
+            if requested_at is not None:
+                METRICS.observe("musicbot_play_to_audio_seconds", now - requested_at)
+                log_event("play_to_audio", guild=guild_id, seconds=round(now - requested_at, 3))
+            ended_at, player.track_ended_at = player.track_ended_at, None
+            if ended_at is not None:
+                METRICS.observe("musicbot_track_gap_seconds", now - ended_at)
+                log_event("track_gap", guild=guild_id, seconds=round(now - ended_at, 3))
+            # Ha llegado audio: se acabó la racha de fallos
+            player.failures = 0
+            track.failures = 0
+
+        instrumented = InstrumentedSource(source, first_packet, offset)
 
         def after_play(error):
+            player.track_ended_at = time.monotonic()
+            skipped, player.skip_requested = player.skip_requested, False
             if error:
-                print(f"Error playing {title}: {error}")
-            asyncio.run_coroutine_threadsafe(play_next_song(voice_client, guild_id, channel), bot.loop)
-
-        voice_client.play(source, after=after_play)
-        # Enviar mensaje con controles de reacción
-        message = await channel.send(f"Now playing: **{title}**")
-        # Añadir reacciones para control
-        control_reactions = ["⏯️", "⏭️", "🔁", "🔀", "⏹️", "📋"]
-        for reaction in control_reactions:
-            await message.add_reaction(reaction)
+                METRICS.inc("musicbot_playback_errors_total", stage="play")
+                log_event("playback_error", level="error", guild=guild_id, title=title, error=str(error))
+            # Sin ningún paquete de audio (p. ej. URL caducada o rechazada) también es un fallo
+            empty = not (instrumented.started or skipped)
+            # ffmpeg termina sin error cuando se corta la conexión: el tema acaba antes de tiempo
+            cut_short = (
+                not skipped and instrumented.started and track.duration
+                and instrumented.elapsed < track.duration - STREAM_CUT_MARGIN
+            )
+            if error or empty or cut_short:
+                if empty and not error:
+                    METRICS.inc("musicbot_playback_errors_total", stage="empty")
+                elif cut_short and not error:
+                    METRICS.inc("musicbot_playback_errors_total", stage="cut")
+                # Al reintentar se continúa donde se quedó
+                track.start_at = instrumented.elapsed
+                next_step = handle_stream_failure(voice_client, guild_id, channel, track, requeued=player.loop_mode != "none")
+            else:
+                next_step = play_next_song(voice_client, guild_id, channel)
+            asyncio.run_coroutine_threadsafe(next_step, bot.loop)
+
+        voice_client.play(instrumented, after=after_play)
+        player.now_playing = track
+        player.now_playing_source = instrumented
+        # Preparar las siguientes canciones mientras suena esta
+        schedule_prefetch(player)
+        schedule_prewarm(voice_client, player, track)
+        # Mostrar la canción actual con los controles de reacción, sin bloquear la reproducción
+        announce_now_playing(player, channel, title)
         
         # Guardar la última canción reproducida para recomendaciones
-        voice_client.last_played = title
+        player.last_played = title
+        record_history(player, track)
+        schedule_recommendations(player)
     else:
+        player.discard_prewarmed()
+        player.now_playing = None
+        player.now_playing_source = None
+        # El silencio hasta la próxima canción ya no es un hueco entre canciones
+        player.track_ended_at = None
+
         # Verificar si hay recomendaciones activadas para este servidor
-        if guild_id in RECOMMENDATIONS_ENABLED and RECOMMENDATIONS_ENABLED[guild_id]:
-            # Buscar la última canción reproducida para generar recomendaciones
-            if hasattr(voice_client, "last_played") and voice_client.last_played:
-                last_title = voice_client.last_played
-                await channel.send(f"La cola ha terminado. Buscando recomendaciones basadas en: **{last_title}**")
-                
-                # Buscar recomendaciones
-                await get_recommendations(voice_client, guild_id, channel, last_title)
-            else:
-                # Si no hay historial, programar desconexión
-                if not hasattr(voice_client, "disconnect_task") or voice_client.disconnect_task.done():
-                    voice_client.disconnect_task = asyncio.create_task(disconnect_after_timeout(voice_client, 300))
+        if player.recommendations and player.last_played:
+            # Buscar recomendaciones a partir de la última canción reproducida
+            last_title = player.last_played
+            if player.recommended is None:
+                DISPATCHER.send(channel, f"La cola ha terminado. Buscando recomendaciones basadas en: **{last_title}**")
+            await get_recommendations(voice_client, guild_id, channel, last_title)
         else:
             # En lugar de desconectar inmediatamente, programamos una desconexión después de 5 minutos
-            if not hasattr(voice_client, "disconnect_task") or voice_client.disconnect_task.done():
-                voice_client.disconnect_task = asyncio.create_task(disconnect_after_timeout(voice_client, 300))  # 300 segundos = 5 minutos
-        
-        SONG_QUEUES[guild_id] = deque()
+            if player.disconnect_task is None or player.disconnect_task.done():
+                player.disconnect_task = asyncio.create_task(disconnect_after_timeout(voice_client, 300))  # 300 segundos = 5 minutos
+
+# Segundos antes del final a partir de los cuales un stream que termina ya no cuenta como cortado
+STREAM_CUT_MARGIN = 10.0
+# Intentos extra para una canción cuyo stream falla, y espera máxima entre fallos seguidos
+STREAM_RETRIES = 1
+STREAM_BACKOFF_BASE = 1.0
+STREAM_BACKOFF_MAX = 30.0
+
+
+def requeue_at_front(player, track, requeued):
+    """Vuelve a poner la canción la primera de la cola.
+
+    requeued indica si el modo bucle ya la ha vuelto a añadir: en bucle de
+    canción ya está delante y en bucle de cola se quita la copia del final.
+    """
+    queue = player.queue
+    if requeued and queue and queue[0] is track and player.loop_mode == "song":
+        return
+    if requeued and queue and queue[-1] is track and player.loop_mode == "queue":
+        queue.remove_at(-1)
+    queue.appendleft(track)
+
+
+def stream_backoff(failures):
+    """Espera antes de seguir tras varios fallos seguidos; el primero no espera."""
+    if failures <= 1:
+        return 0.0
+    return min(STREAM_BACKOFF_MAX, STREAM_BACKOFF_BASE * 2 ** (failures - 2))
+
+
+async def handle_stream_failure(voice_client, guild_id, channel, track, requeued):
+    """Reintenta la canción con una URL nueva o pasa a la siguiente, esperando más cuantos más fallos seguidos haya.
+
+    requeued indica si el modo bucle ya ha vuelto a poner la canción en la cola.
+    """
+    if not voice_client.is_connected():
+        return
+    player = get_player(guild_id)
+    player.failures += 1
+    track.failures += 1
+    # La URL de audio puede haber caducado o estar bloqueada: pedir otra
+    track.expires_at = 0.0
+    retry = track.failures <= STREAM_RETRIES
+    # En bucle de canción ya vuelve a estar la primera de la cola
+    at_front = requeued and player.loop_mode == "song" and player.queue and player.queue[0] is track
+    if retry:
+        requeue_at_front(player, track, requeued)
+    else:
+        # Si vuelve a sonar por el bucle, que sea desde el principio
+        track.start_at = 0.0
+        if at_front:
+            # Se repetiría para siempre
+            player.queue.popleft()
+
+    delay = stream_backoff(player.failures)
+    log_event("stream_failure", level="warning", guild=guild_id, title=track.title, retry=retry,
+              failures=player.failures, delay=delay)
+    if retry and track.start_at:
+        DISPATCHER.send(
+            channel, f"Se ha cortado **{track.title}**, continuando desde {format_duration(track.start_at)}...",
+            key=("failure", guild_id),
+        )
+    elif retry:
+        DISPATCHER.send(channel, f"Fallo al reproducir **{track.title}**, reintentando...", key=("failure", guild_id))
+    else:
+        DISPATCHER.send(channel, f"No se pudo reproducir **{track.title}**, pasando a la siguiente.", key=("failure", guild_id))
+    if delay:
+        await asyncio.sleep(delay)
+    # Durante la espera pueden haber parado el bot o empezado otra canción
+    if voice_client.is_playing() or voice_client.is_paused():
+        return
+    await play_next_song(voice_client, guild_id, channel)
+
 
 async def disconnect_after_timeout(voice_client, timeout):
     try:
@@ -454,53 +3753,90 @@ async def disconnect_after_timeout(voice_client, timeout):
         pass  # La tarea fue cancelada, probablemente porque se reprodujo una nueva canción
 
 
-# Función para verificar si hay usuarios en el canal de voz
-async def check_voice_channel(voice_client):
-    while voice_client.is_connected():
-        try:
-            # Verificar si hay miembros en el canal de voz (excluyendo al bot)
-            members = voice_client.channel.members
-            real_members = [m for m in members if not m.bot]
-            
-            # Si no hay miembros reales, desconectar después de 10 segundos
-            if not real_members:
-                print("No hay usuarios en el canal, esperando 10 segundos antes de desconectar...")
-                await asyncio.sleep(10)  # Esperar 10 segundos
-                
-                # Verificar nuevamente si no hay miembros (por si alguien se unió)
-                if voice_client.is_connected():  # Verificar que el cliente siga conectado
-                    members = voice_client.channel.members
-                    real_members = [m for m in members if not m.bot]
-                    
-                    if not real_members and voice_client.is_connected():
-                        print("Desconectando por inactividad (canal vacío)")
-                        await voice_client.disconnect()
-                        break
-            
-            # Verificar cada 5 segundos
-            await asyncio.sleep(5)
-        except Exception as e:
-            print(f"Error en check_voice_channel: {e}")
-            await asyncio.sleep(5)  # En caso de error, esperar y continuar
-    return
+# Segundos que se espera con el canal vacío antes de desconectar
+EMPTY_CHANNEL_TIMEOUT = 10
+
+
+class ChannelPresence:
+    """Lleva la cuenta de usuarios (no bots) en los canales de voz donde está el bot.
+
+    Se actualiza con on_voice_state_update, así que no hace falta recorrer los
+    miembros del canal periódicamente.
+    """
+
+    def __init__(self):
+        self.counts = {}
+
+    def track(self, channel):
+        # Recuento inicial al entrar el bot en el canal
+        self.counts[channel.id] = sum(1 for m in channel.members if not m.bot)
+
+    def untrack(self, channel):
+        self.counts.pop(channel.id, None)
+
+    def is_empty(self, channel):
+        return self.counts.get(channel.id, 0) == 0
+
+    def member_moved(self, before, after):
+        if before is not None and before.id in self.counts:
+            self.counts[before.id] = max(0, self.counts[before.id] - 1)
+        if after is not None and after.id in self.counts:
+            self.counts[after.id] += 1
+
+
+VOICE_PRESENCE = ChannelPresence()
+
+
+async def disconnect_if_empty(guild, channel):
+    try:
+        print(f"No hay usuarios en el canal, esperando {EMPTY_CHANNEL_TIMEOUT} segundos antes de desconectar...")
+        await asyncio.sleep(EMPTY_CHANNEL_TIMEOUT)
+        voice_client = guild.voice_client
+        # Verificar nuevamente que siga vacío (por si alguien se unió) y que el bot siga ahí
+        if voice_client and voice_client.is_connected() and voice_client.channel.id == channel.id \
+                and VOICE_PRESENCE.is_empty(channel):
+            print("Desconectando por inactividad (canal vacío)")
+            await voice_client.disconnect()
+    except asyncio.CancelledError:
+        pass  # Alguien volvió al canal
+
+
+def update_empty_timer(guild, channel):
+    """Programa o cancela el único temporizador de desconexión del servidor."""
+    player = get_player(guild.id)
+    task = player.empty_channel_task
+    pending = task is not None and not task.done()
+    if VOICE_PRESENCE.is_empty(channel):
+        if pending and player.empty_channel_id == channel.id:
+            return
+        # El bot se movió a otro canal vacío: el temporizador anterior ya no lo desconectaría
+        if pending:
+            task.cancel()
+        player.empty_channel_task = asyncio.create_task(disconnect_if_empty(guild, channel))
+        player.empty_channel_id = channel.id
+    elif pending:
+        task.cancel()
+        player.empty_channel_task = None
+        player.empty_channel_id = None
 
 
 @bot.tree.command(name="sync", description="Sincroniza los comandos con Discord")
 async def sync(interaction: discord.Interaction):
     if interaction.user.guild_permissions.administrator:
-        await bot.tree.sync()
-        await interaction.response.send_message("¡Comandos sincronizados con éxito!")
+        await interaction.response.defer()
+        await sync_commands(force=True)
+        await interaction.followup.send("¡Comandos sincronizados con éxito!")
     else:
         await interaction.response.send_message("Necesitas permisos de administrador para usar este comando.")
 
 
 @bot.tree.command(name="loop", description="Controla el modo de bucle (none, song, queue)")
 async def loop(interaction: discord.Interaction, mode: str = None):
-    guild_id = str(interaction.guild_id)
+    player = get_player(interaction.guild_id)
     
     # Si no se proporciona un modo, mostrar el modo actual
     if mode is None:
-        current_mode = LOOP_MODES.get(guild_id, "none")
+        current_mode = player.loop_mode
         await interaction.response.send_message(f"Modo de bucle actual: **{current_mode}**")
         return
     
@@ -513,7 +3849,7 @@ async def loop(interaction: discord.Interaction, mode: str = None):
         return
     
     # Establecer el modo de bucle
-    LOOP_MODES[guild_id] = mode
+    player.loop_mode = mode
     
     # Responder al usuario
     if mode == "none":
@@ -526,86 +3862,201 @@ async def loop(interaction: discord.Interaction, mode: str = None):
 
 @bot.tree.command(name="clear", description="Limpia la cola de reproducción actual.")
 async def clear(interaction: discord.Interaction):
-    guild_id = str(interaction.guild_id)
+    player = get_player(interaction.guild_id)
     
-    if guild_id not in SONG_QUEUES or not SONG_QUEUES[guild_id]:
+    if not player.queue:
         await interaction.response.send_message("La cola de reproducción ya está vacía.")
         return
     
     # Guardar la cantidad de canciones que había en la cola
-    queue_size = len(SONG_QUEUES[guild_id])
+    queue_size = len(player.queue)
     
     # Limpiar la cola
-    SONG_QUEUES[guild_id].clear()
+    player.queue.clear()
+    player.discard_prewarmed()
     
     await interaction.response.send_message(f"Se han eliminado {queue_size} canciones de la cola de reproducción.")
 
 
 @bot.tree.command(name="shuffle", description="Mezcla aleatoriamente las canciones en la cola.")
 async def shuffle(interaction: discord.Interaction):
-    guild_id = str(interaction.guild_id)
+    player = get_player(interaction.guild_id)
     
-    if guild_id not in SONG_QUEUES or not SONG_QUEUES[guild_id]:
+    if not player.queue:
         await interaction.response.send_message("La cola de reproducción está vacía.")
         return
     
-    if len(SONG_QUEUES[guild_id]) < 2:
+    if len(player.queue) < 2:
         await interaction.response.send_message("Necesitas al menos 2 canciones en la cola para mezclarlas.")
         return
     
-    # Guardar la primera canción (la que se está reproduciendo actualmente)
-    current_song = None
-    if SONG_QUEUES[guild_id]:
-        current_song = SONG_QUEUES[guild_id][0]
-        remaining_songs = SONG_QUEUES[guild_id][1:]
-        
-        # Mezclar el resto de canciones
-        import random
-        random.shuffle(remaining_songs)
-        
-        # Reconstruir la cola con la canción actual al principio
-        SONG_QUEUES[guild_id] = [current_song] + remaining_songs
+    # Mezclar el resto de canciones, dejando la primera en su sitio
+    player.queue.shuffle(keep_first=True)
     
+    # Las siguientes canciones han cambiado, precargar las nuevas
+    schedule_prefetch(player)
     await interaction.response.send_message("La cola de reproducción ha sido mezclada aleatoriamente.")
 
 
+@bot.tree.command(name="remove", description="Quita una canción de la cola por su posición.")
+@app_commands.describe(position="Posición en la cola (empezando en 1)")
+async def remove(interaction: discord.Interaction, position: int):
+    player = get_player(interaction.guild_id)
+    
+    if not 1 <= position <= len(player.queue):
+        await interaction.response.send_message(f"Posición no válida. La cola tiene {len(player.queue)} canciones.")
+        return
+    
+    track = player.queue.remove_at(position - 1)
+    # Si era una de las siguientes, precargar las que ahora ocupan su lugar
+    if position <= PREFETCH_COUNT:
+        schedule_prefetch(player)
+    await interaction.response.send_message(f"Eliminada de la cola: **{track.title}**")
+
+
+@bot.tree.command(name="move", description="Mueve una canción de la cola a otra posición.")
+@app_commands.describe(source="Posición actual (empezando en 1)", destination="Nueva posición")
+async def move(interaction: discord.Interaction, source: int, destination: int):
+    player = get_player(interaction.guild_id)
+    length = len(player.queue)
+    
+    if not 1 <= source <= length or not 1 <= destination <= length:
+        await interaction.response.send_message(f"Posición no válida. La cola tiene {length} canciones.")
+        return
+    
+    track = player.queue.move(source - 1, destination - 1)
+    if min(source, destination) <= PREFETCH_COUNT:
+        schedule_prefetch(player)
+    await interaction.response.send_message(f"**{track.title}** movida a la posición {destination}.")
+
+
 @bot.tree.command(name="recommendations", description="Activa o desactiva las recomendaciones automáticas")
 async def recommendations(interaction: discord.Interaction, enabled: bool = None):
-    guild_id = str(interaction.guild_id)
+    player = get_player(interaction.guild_id)
     
     # Si no se proporciona un valor, mostrar el estado actual
     if enabled is None:
-        current_state = RECOMMENDATIONS_ENABLED.get(guild_id, False)
+        current_state = player.recommendations
         await interaction.response.send_message(f"Las recomendaciones automáticas están {'activadas' if current_state else 'desactivadas'}.")
         return
     
     # Establecer el nuevo estado
-    RECOMMENDATIONS_ENABLED[guild_id] = enabled
+    player.recommendations = enabled
     
     # Responder al usuario
     if enabled:
+        schedule_recommendations(player)
         await interaction.response.send_message("Recomendaciones automáticas activadas. Cuando termine la cola, se añadirán canciones similares.")
     else:
         await interaction.response.send_message("Recomendaciones automáticas desactivadas.")
 
 
+# Canciones por página al mostrar la cola
+QUEUE_PAGE_SIZE = 10
+
+
+def format_duration(seconds):
+    seconds = int(seconds or 0)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+TIMESTAMP_PART_RE = re.compile(r"\d+(?:\.\d+)?")
+
+
+def parse_timestamp(text):
+    """Convierte "90", "1:30" o "1:02:03" en segundos; None si no es válido."""
+    parts = text.strip().split(":")
+    if not 1 <= len(parts) <= 3:
+        return None
+    # Solo dígitos (con decimales): float() también aceptaría "nan", "inf" o "1e3"
+    if not all(TIMESTAMP_PART_RE.fullmatch(part) for part in parts):
+        return None
+    values = [float(part) for part in parts]
+    if any(value >= 60 for value in values[1:]):
+        return None
+    seconds = 0.0
+    for value in values:
+        seconds = seconds * 60 + value
+    return seconds
+
+
+def queue_page_count(player):
+    return max(1, -(-len(player.queue) // QUEUE_PAGE_SIZE))
+
+
+def render_queue_page(player, page):
+    """Genera el embed de una página de la cola, reutilizándolo mientras la cola no cambie."""
+    queue = player.queue
+    if player.queue_pages is None or player.queue_pages[0] != queue.version:
+        player.queue_pages = (queue.version, {})
+    pages = player.queue_pages[1]
+    embed = pages.get(page)
+    if embed is not None:
+        return embed
+
+    start = page * QUEUE_PAGE_SIZE
+    lines = []
+    for position, (_, track) in enumerate(queue.entries(start, start + QUEUE_PAGE_SIZE), start + 1):
+        title = track.title if len(track.title) <= 80 else track.title[:77] + "..."
+        duration = format_duration(track.duration) if track.duration else "?"
+        lines.append(f"{position}. {title} ({duration})")
+
+    total = format_duration(queue.total_duration)
+    if queue.unknown_durations:
+        total += f" (+{queue.unknown_durations} sin duración)"
+    embed = discord.Embed(title="Cola de reproducción", description="\n".join(lines) or "La cola está vacía.")
+    embed.set_footer(
+        text=f"Página {page + 1}/{queue_page_count(player)} · {len(queue)} canciones · Duración total: {total}"
+    )
+    pages[page] = embed
+    return embed
+
+
+class QueueView(discord.ui.View):
+    """Botones para recorrer las páginas de la cola."""
+
+    def __init__(self, player, page=0):
+        super().__init__(timeout=180)
+        self.player = player
+        self.page = page
+
+    def render(self):
+        self.page = max(0, min(self.page, queue_page_count(self.player) - 1))
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= queue_page_count(self.player) - 1
+        return render_queue_page(self.player, self.page)
+
+    @discord.ui.button(emoji="◀️", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page -= 1
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    @discord.ui.button(emoji="▶️", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+
 @bot.tree.command(name="queue", description="Muestra la cola de reproducción actual.")
-async def queue(interaction: discord.Interaction):
-    guild_id = str(interaction.guild_id)
+@app_commands.describe(page="Página de la cola (empezando en 1)")
+async def queue(interaction: discord.Interaction, page: int = 1):
+    player = get_player(interaction.guild_id)
     
-    if guild_id not in SONG_QUEUES or not SONG_QUEUES[guild_id]:
+    if not player.queue:
         await interaction.response.send_message("La cola de reproducción está vacía.")
         return
     
-    queue_list = list(SONG_QUEUES[guild_id])
-    
-    # Crear un mensaje con la lista de canciones en cola
-    message = "**Cola de reproducción:**\n"
-    for i, (_, title) in enumerate(queue_list, 1):
-        message += f"{i}. {title}\n"
-    
-    await interaction.response.send_message(message)
+    view = QueueView(player, page - 1)
+    await interaction.response.send_message(embed=view.render(), view=view)
 
 
 # Run the bot
-bot.run(TOKEN)
\ No newline at end of file
+if __name__ == "__main__":
+    mark_startup("import")
+    bot.run(TOKEN)
+    if STATE_STORE is not None:
+        STATE_STORE.shutdown(list(PLAYERS.values()))
\ No newline at end of file
@@ -0,0 +1,438 @@
+# Benchmark y prueba de carga del bot sin conectarse a Discord ni a YouTube
+#
+# Usa un VoiceClient, canales e interacciones falsos y un extractor de yt-dlp
+# determinista con latencia configurable. Ejemplo:
+#
+#   python benchmark.py --guilds 1 100 1000 --latency 0.2
+import argparse
+import asyncio
+import hashlib
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import discord
+
+import MusicBot
+
+BOT_USER_ID = 1
+
+
+# ---------------------------------------------------------------------------
+# Extractor falso
+# ---------------------------------------------------------------------------
+
+class FakeYoutubeDL:
+    """Sustituto de yt_dlp.YoutubeDL que devuelve resultados deterministas."""
+
+    latency = 0.2
+    jitter = 0.05
+    playlist_size = 50
+    calls = 0
+
+    def __init__(self, opts):
+        self.opts = opts
+
+    def _sleep(self, query):
+        # Latencia reproducible: depende solo de la consulta
+        rng = random.Random(query)
+        time.sleep(max(0.0, self.latency + rng.uniform(-self.jitter, self.jitter)))
+        FakeYoutubeDL.calls += 1
+
+    @staticmethod
+    def _video_id(seed):
+        return hashlib.sha1(seed.encode()).hexdigest()[:11]
+
+    def _video(self, video_id, flat=False):
+        info = {
+            "id": video_id,
+            "title": f"Canción {video_id}",
+            "duration": 180 + int(video_id, 16) % 120,
+            "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+        }
+        if flat:
+            info["_type"] = "url"
+            info["url"] = info["webpage_url"]
+        else:
+            expire = int(time.time()) + 6 * 3600
+            info["url"] = f"https://fake.googlevideo.com/videoplayback?id={video_id}&expire={expire}"
+            info["acodec"] = "opus"
+            info["abr"] = 70
+        return info
+
+    def extract_info(self, query, download=False, ie_key=None, process=True):
+        self._sleep(query)
+        flat = bool(self.opts.get("extract_flat"))
+        if query.startswith("ytsearch"):
+            prefix, _, terms = query.partition(":")
+            count = int(prefix[len("ytsearch"):] or 1)
+            entries = [self._video(self._video_id(f"{terms.strip()}#{i}"), flat) for i in range(count)]
+            return {"_type": "playlist", "title": terms.strip(), "entries": entries}
+        if "list=" in query:
+            entries = (
+                self._video(self._video_id(f"{query}#{i}"), flat=True) for i in range(self.playlist_size)
+            )
+            if process:
+                entries = list(entries)
+            return {"_type": "playlist", "title": f"Lista {query[-6:]}", "entries": entries}
+        kind, _, value = MusicBot.normalize_query(query).partition(":")
+        video_id = value if kind == "id" else self._video_id(query)
+        return self._video(video_id, flat=not process)
+
+
+# ---------------------------------------------------------------------------
+# Objetos falsos de Discord
+# ---------------------------------------------------------------------------
+
+class FakeSource:
+    def cleanup(self):
+        pass
+
+
+class FakeMessage:
+    send_latency = 0.0
+    ids = itertools.count(1)
+
+    def __init__(self, content, channel):
+        self.id = next(self.ids)
+        self.content = content
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = SimpleNamespace(id=BOT_USER_ID, bot=True)
+
+    async def add_reaction(self, emoji):
+        await asyncio.sleep(self.send_latency)
+
+    async def edit(self, content=None, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.content = content
+
+
+class FakeTextChannel:
+    def __init__(self, guild):
+        self.guild = guild
+        self.id = guild.id * 10 + 2
+        self.last_message_id = None
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(FakeMessage.send_latency)
+        self.sent += 1
+        message = FakeMessage(content, self)
+        self.last_message_id = message.id
+        return message
+
+
+class FakeVoiceClient:
+    """Simula la reproducción: una canción suena hasta que se llama a stop()."""
+
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self._connected = True
+        self._playing = False
+        self._paused = False
+        self._after = None
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._playing and not self._paused
+
+    def is_paused(self):
+        return self._paused
+
+    def play(self, source, *, after=None):
+        self._playing = True
+        self._paused = False
+        self._after = after
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    def stop(self):
+        after, self._after = self._after, None
+        self._playing = False
+        self._paused = False
+        if after is not None:
+            # discord.py llama a "after" desde el hilo del reproductor
+            asyncio.get_running_loop().call_soon(after, None)
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self._connected = False
+        self.guild.voice_client = None
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild):
+        self.guild = guild
+        self.id = guild.id * 10
+        self.members = [SimpleNamespace(id=guild.id * 10 + 1, bot=False)]
+
+    async def connect(self):
+        self.guild.voice_client = FakeVoiceClient(self.guild, self)
+        return self.guild.voice_client
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.voice_client = None
+        self.voice_channel = FakeVoiceChannel(self)
+        self.text_channel = FakeTextChannel(self)
+
+
+class FakeResponse:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def defer(self, **kwargs):
+        await asyncio.sleep(FakeMessage.send_latency)
+
+    async def send_message(self, content=None, **kwargs):
+        await self.channel.send(content)
+
+
+class FakeFollowup:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def send(self, content=None, wait=False, **kwargs):
+        return await self.channel.send(content)
+
+
+class FakeInteraction:
+    def __init__(self, guild):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel = guild.text_channel
+        self.created_at = discord.utils.utcnow()
+        self.user = SimpleNamespace(
+            id=guild.id * 10 + 1,
+            voice=SimpleNamespace(channel=guild.voice_channel),
+            guild_permissions=SimpleNamespace(administrator=True),
+        )
+        self.response = FakeResponse(guild.text_channel)
+        self.followup = FakeFollowup(guild.text_channel)
+
+
+def fake_reaction(guild, emoji):
+    message = FakeMessage("", guild.text_channel)
+    return SimpleNamespace(emoji=emoji, message=message)
+
+
+# ---------------------------------------------------------------------------
+# Medidas
+# ---------------------------------------------------------------------------
+
+def percentiles(samples):
+    if not samples:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": ordered[-1]}
+
+
+class LoopLagMonitor:
+    """Mide cuánto se retrasa el bucle de eventos respecto a un tick fijo."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.perf_counter() - start - self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def timed(samples, coro):
+    start = time.perf_counter()
+    await coro
+    samples.append(time.perf_counter() - start)
+
+
+def format_ms(stats):
+    return "  ".join(f"{name}={value * 1000:.1f}ms" for name, value in stats.items())
+
+
+# ---------------------------------------------------------------------------
+# Escenario
+# ---------------------------------------------------------------------------
+
+def reset_bot_state(workdir, workers):
+    """Deja el módulo MusicBot listo para un escenario nuevo."""
+    MusicBot.PLAYERS.clear()
+    MusicBot.EXTRACT_CACHE = MusicBot.ExtractionCache(
+        os.path.join(workdir, f"cache-{time.monotonic_ns()}.sqlite3"), MusicBot.EXTRACT_CACHE_SIZE
+    )
+    MusicBot.EXTRACT_ENGINE = MusicBot.ExtractionEngine(workers, ydl_factory=FakeYoutubeDL)
+    MusicBot.DISPATCHER = MusicBot.OutboundDispatcher()
+    MusicBot.EXTRACT_FLIGHTS = MusicBot.SingleFlight()
+    MusicBot.RECOMMENDATION_INDEX = MusicBot.RecommendationIndex(
+        os.path.join(workdir, f"recommendations-{time.monotonic_ns()}.sqlite3")
+    )
+    MusicBot.STATE_STORE = MusicBot.StateStore(os.path.join(workdir, f"state-{time.monotonic_ns()}.sqlite3"))
+    FakeYoutubeDL.calls = 0
+
+
+async def run_scenario(guild_count, args, workdir):
+    reset_bot_state(workdir, args.workers)
+    guilds = [FakeGuild(1000 + i) for i in range(guild_count)]
+
+    # tracemalloc ralentiza todo; con --no-memory las latencias son más fieles
+    if args.memory:
+        tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    monitor = LoopLagMonitor()
+    monitor.start()
+
+    # /play: búsquedas que se repiten entre servidores para ejercitar la caché
+    play_latency = []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        timed(play_latency, MusicBot.play.callback(FakeInteraction(guild), f"canción {i % args.distinct}"))
+        for i, guild in enumerate(guilds)
+    ))
+    for extra in range(args.queue_size):
+        await asyncio.gather(*(
+            timed(play_latency, MusicBot.play.callback(FakeInteraction(guild), f"extra {extra} {i % args.distinct}"))
+            for i, guild in enumerate(guilds)
+        ))
+    # Una lista de reproducción por cada diez servidores
+    await asyncio.gather(*(
+        timed(play_latency, MusicBot.play.callback(
+            FakeInteraction(guild), f"https://www.youtube.com/playlist?list=PL{i % args.distinct:08d}"
+        ))
+        for i, guild in enumerate(guilds) if i % 10 == 0
+    ))
+    play_elapsed = time.perf_counter() - started
+
+    # Operaciones de cola: comandos y reacciones
+    queue_ops = 0
+    started = time.perf_counter()
+    for guild in guilds:
+        await MusicBot.queue.callback(FakeInteraction(guild))
+        await MusicBot.shuffle.callback(FakeInteraction(guild))
+        for emoji in ("📋", "🔀", "🔁", "⏭️", "🔁", "🔁"):
+            await MusicBot.on_reaction_add(fake_reaction(guild, emoji), SimpleNamespace(bot=False))
+        await MusicBot.skip.callback(FakeInteraction(guild))
+        queue_ops += 10
+    # Dejar que terminen los play_next_song lanzados por los saltos
+    await asyncio.sleep(0)
+    queue_elapsed = time.perf_counter() - started
+
+    # Recomendaciones
+    recommendation_latency = []
+    await asyncio.gather(*(
+        timed(recommendation_latency, MusicBot.get_recommendations(
+            guild.voice_client, guild.id, guild.text_channel, f"canción {i % args.distinct}"
+        ))
+        for i, guild in enumerate(guilds)
+    ))
+
+    await asyncio.sleep(0.1)
+    memory_after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    await monitor.stop()
+
+    for guild in guilds:
+        await MusicBot.clear.callback(FakeInteraction(guild))
+        if guild.voice_client is not None:
+            await guild.voice_client.disconnect()
+    for player in list(MusicBot.PLAYERS.values()):
+        player.close()
+
+    return {
+        "guilds": guild_count,
+        "play": percentiles(play_latency),
+        "play_per_s": len(play_latency) / play_elapsed if play_elapsed else 0.0,
+        "queue_ops_per_s": queue_ops / queue_elapsed if queue_elapsed else 0.0,
+        "recommendations": percentiles(recommendation_latency),
+        "loop_lag": percentiles(monitor.samples),
+        "memory_per_guild": (memory_after - memory_before) / guild_count if args.memory else None,
+        "extractor_calls": FakeYoutubeDL.calls,
+        "cache": MusicBot.EXTRACT_CACHE.stats(),
+        "engine": MusicBot.EXTRACT_ENGINE.stats(),
+        "single_flight": MusicBot.EXTRACT_FLIGHTS.stats(),
+        "dispatcher": MusicBot.DISPATCHER.stats(),
+        "messages": sum(guild.text_channel.sent for guild in guilds),
+    }
+
+
+def print_report(result):
+    print(f"=== {result['guilds']} servidores ===")
+    print(f"  /play                 {format_ms(result['play'])}  ({result['play_per_s']:.1f}/s)")
+    print(f"  recomendaciones       {format_ms(result['recommendations'])}")
+    print(f"  operaciones de cola   {result['queue_ops_per_s']:.0f}/s")
+    print(f"  lag del event loop    {format_ms(result['loop_lag'])}")
+    if result["memory_per_guild"] is not None:
+        print(f"  memoria por servidor  {result['memory_per_guild'] / 1024:.1f} KiB")
+    print(f"  llamadas al extractor {result['extractor_calls']}  caché={result['cache']}")
+    print(f"  motor de extracción   {result['engine']}")
+    print(f"  peticiones agrupadas  {result['single_flight']}")
+    print(f"  mensajes enviados     {result['messages']}  dispatcher={result['dispatcher']}")
+
+
+async def main(args):
+    FakeYoutubeDL.latency = args.latency
+    FakeYoutubeDL.jitter = args.jitter
+    FakeYoutubeDL.playlist_size = args.playlist_size
+    FakeMessage.send_latency = args.send_latency
+
+    # Sin ffmpeg ni conexión a Discord
+    MusicBot.create_audio_source = lambda audio_url, track, profile, start_at=0.0: FakeSource()
+    MusicBot.bot.loop = asyncio.get_running_loop()
+    MusicBot.bot._connection.user = SimpleNamespace(id=BOT_USER_ID, bot=True)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for guild_count in args.guilds:
+            print_report(await run_scenario(guild_count, args, workdir))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark del bot de música con Discord y yt-dlp simulados")
+    parser.add_argument("--guilds", type=int, nargs="+", default=[1, 100, 1000],
+                        help="número de servidores simulados en cada escenario")
+    parser.add_argument("--latency", type=float, default=0.2, help="latencia media del extractor (s)")
+    parser.add_argument("--jitter", type=float, default=0.05, help="variación de la latencia del extractor (s)")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="latencia de los envíos a Discord (s)")
+    parser.add_argument("--workers", type=int, default=MusicBot.EXTRACT_WORKERS, help="hilos del extractor")
+    parser.add_argument("--distinct", type=int, default=50, help="búsquedas distintas entre todos los servidores")
+    parser.add_argument("--queue-size", type=int, default=5, help="canciones extra añadidas por servidor")
+    parser.add_argument("--playlist-size", type=int, default=50, help="canciones de cada lista simulada")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="no medir memoria (tracemalloc añade bastante sobrecarga)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args(sys.argv[1:])))
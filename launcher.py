@@ -0,0 +1,263 @@
+# Lanza el bot en varios procesos, cada uno con un grupo de shards
+#
+# Cada proceso es un MusicBot.py normal con AutoShardedBot; el estado de los
+# servidores no se comparte entre procesos. El launcher vigila los procesos por
+# su canal de control local (health/stats), los reinicia si se caen y muestra
+# estadísticas agregadas. Ejemplo:
+#
+#   python launcher.py --shards 8 --processes 4
+#   python launcher.py --processes 4 --status
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "MusicBot.py")
+
+
+def recommended_shard_count(token):
+    """Número de shards que recomienda Discord para el bot."""
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot (launcher, 1.0)"},
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)["shards"]
+
+
+def split_shards(shard_count, processes):
+    """Reparte los shards 0..shard_count-1 en grupos contiguos, uno por proceso."""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    groups = []
+    start = 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(list(range(start, end)))
+        start = end
+    return groups
+
+
+async def query(port, command, timeout=5.0):
+    """Envía una orden al canal de control de un proceso y devuelve la respuesta."""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+    try:
+        writer.write(command.encode() + b"\n")
+        await writer.drain()
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        return json.loads(line)
+    finally:
+        writer.close()
+
+
+def aggregate(results):
+    """Suma campo a campo las estadísticas numéricas de varios procesos."""
+    total = {}
+    for result in results:
+        for key, value in result.items():
+            if isinstance(value, bool) or value is None:
+                continue
+            if isinstance(value, dict):
+                total[key] = aggregate([total.get(key, {}), value])
+            elif isinstance(value, (int, float)):
+                total[key] = total.get(key, 0) + value
+    return total
+
+
+class Worker:
+    """Un proceso del bot con su grupo de shards."""
+
+    def __init__(self, index, shard_ids, shard_count, control_port, ffmpeg_max_processes, metrics_port=0):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.control_port = control_port
+        self.metrics_port = metrics_port
+        self.ffmpeg_max_processes = ffmpeg_max_processes
+        self.process = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.next_start = 0.0
+        self.failed_checks = 0
+
+    @property
+    def label(self):
+        return f"proceso {self.index} (shards {self.shard_ids[0]}-{self.shard_ids[-1]})"
+
+    def start(self):
+        env = dict(os.environ)
+        env["SHARD_COUNT"] = str(self.shard_count)
+        env["SHARD_IDS"] = ",".join(str(shard_id) for shard_id in self.shard_ids)
+        env["CONTROL_PORT"] = str(self.control_port)
+        # Cada proceso sirve sus métricas en su propio puerto (0 = desactivadas)
+        env["METRICS_PORT"] = str(self.metrics_port)
+        # La caché de audio borra archivos al llenarse: cada proceso usa la suya
+        audio_dir = os.getenv("AUDIO_CACHE_DIR", os.path.join("cache", "audio"))
+        env["AUDIO_CACHE_DIR"] = os.path.join(audio_dir, f"worker-{self.index}")
+        # Cada proceso cuenta solo sus ffmpeg: el máximo de la máquina se reparte entre todos
+        env["FFMPEG_MAX_PROCESSES"] = str(self.ffmpeg_max_processes)
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env)
+        self.started_at = time.monotonic()
+        self.failed_checks = 0
+        print(f"Iniciado {self.label}, pid {self.process.pid}, control en el puerto {self.control_port}")
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.alive():
+            self.process.terminate()
+
+    def schedule_restart(self):
+        # Espera creciente para no reiniciar en bucle un proceso que falla al arrancar
+        if time.monotonic() - self.started_at > 300:
+            self.restarts = 0
+        delay = min(60, 2 ** self.restarts)
+        self.restarts += 1
+        self.next_start = time.monotonic() + delay
+        self.process = None
+        print(f"{self.label} se ha detenido; se reinicia en {delay} s")
+
+
+async def supervise(workers, args):
+    # Escalonar el arranque: Discord limita los IDENTIFY a uno cada pocos segundos
+    for worker in workers:
+        worker.start()
+        await asyncio.sleep(len(worker.shard_ids) * args.identify_delay)
+
+    last_stats = time.monotonic()
+    while True:
+        await asyncio.sleep(args.health_interval)
+        now = time.monotonic()
+        for worker in workers:
+            if worker.process is None:
+                if now >= worker.next_start:
+                    worker.start()
+                continue
+            if not worker.alive():
+                worker.schedule_restart()
+                continue
+            try:
+                health = await query(worker.control_port, "health")
+                worker.failed_checks = 0
+                if not health.get("ready") and now - worker.started_at > args.startup_grace:
+                    print(f"{worker.label} aún no está listo")
+            except (OSError, asyncio.TimeoutError, ValueError):
+                worker.failed_checks += 1
+                # Sin respuesta del canal de control: el event loop está bloqueado o el proceso colgado
+                if worker.failed_checks >= 3 and now - worker.started_at > args.startup_grace:
+                    print(f"{worker.label} no responde; se reinicia")
+                    worker.stop()
+
+        if now - last_stats >= args.stats_interval:
+            last_stats = now
+            print(f"Estadísticas: {json.dumps(await gather_stats(workers))}")
+
+
+async def gather_stats(workers):
+    results = []
+    for worker in workers:
+        try:
+            results.append(await query(worker.control_port, "stats"))
+        except (OSError, asyncio.TimeoutError, ValueError):
+            pass
+    stats = aggregate(results)
+    stats["processes_reporting"] = len(results)
+    return stats
+
+
+async def show_status(args):
+    """Consulta los procesos ya lanzados y muestra su estado y las estadísticas agregadas."""
+    results = []
+    for i in range(args.processes):
+        port = args.control_port + i
+        try:
+            health = await query(port, "health")
+            stats = await query(port, "stats")
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            print(f"proceso {i} (puerto {port}): sin respuesta ({e})")
+            continue
+        results.append(stats)
+        print(f"proceso {i} (puerto {port}): listo={health['ready']} latencia={health['latency']:.3f}s "
+              f"servidores={stats['guilds']} reproductores={stats['players']}")
+    print(json.dumps(aggregate(results), indent=2))
+
+
+async def main(args):
+    if args.status:
+        await show_status(args)
+        return
+
+    shard_count = args.shards or recommended_shard_count(os.getenv("DISCORD_TOKEN"))
+    groups = split_shards(shard_count, args.processes)
+    ffmpeg_per_worker = max(1, args.ffmpeg_max_processes // len(groups))
+    workers = [
+        Worker(
+            i, group, shard_count, args.control_port + i, ffmpeg_per_worker,
+            args.metrics_port + i if args.metrics_port else 0,
+        )
+        for i, group in enumerate(groups)
+    ]
+    print(f"{shard_count} shards repartidos en {len(workers)} procesos, "
+          f"hasta {ffmpeg_per_worker} procesos de ffmpeg cada uno")
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows: Ctrl+C llega como KeyboardInterrupt
+
+    task = asyncio.create_task(supervise(workers, args))
+    try:
+        await stop.wait()
+    finally:
+        task.cancel()
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            if worker.process is not None:
+                try:
+                    worker.process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    worker.process.kill()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Lanza el bot en varios procesos con sharding")
+    parser.add_argument("--shards", type=int, default=int(os.getenv("SHARD_COUNT", "0")),
+                        help="número total de shards (por defecto, el que recomienda Discord)")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("SHARD_PROCESSES", str(os.cpu_count() or 1))),
+                        help="número de procesos del bot")
+    parser.add_argument("--control-port", type=int, default=int(os.getenv("CONTROL_PORT_BASE", "8700")),
+                        help="puerto de control del primer proceso; los demás usan los siguientes")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("METRICS_PORT", "0")),
+                        help="puerto de métricas del primer proceso; los demás usan los siguientes (0 = sin métricas)")
+    parser.add_argument("--ffmpeg-max-processes", type=int, default=int(os.getenv("FFMPEG_MAX_PROCESSES", "64")),
+                        help="procesos de ffmpeg simultáneos en toda la máquina, repartidos entre los procesos del bot")
+    parser.add_argument("--health-interval", type=float, default=15.0)
+    parser.add_argument("--stats-interval", type=float, default=300.0)
+    parser.add_argument("--startup-grace", type=float, default=120.0,
+                        help="segundos que se deja arrancar a un proceso antes de reiniciarlo por no responder")
+    parser.add_argument("--identify-delay", type=float, default=5.0,
+                        help="segundos de espera por shard entre el arranque de un proceso y el siguiente")
+    parser.add_argument("--status", action="store_true",
+                        help="mostrar el estado de los procesos ya lanzados y salir")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(parse_args(sys.argv[1:])))
+    except KeyboardInterrupt:
+        pass